@@ -0,0 +1,388 @@
+"""Offline benchmark for The Mind Vault.
+
+Runs escaperoom.py through Streamlit's AppTest against local stand-ins for the
+OpenAI chat/image endpoints and the ElevenLabs TTS endpoint, so performance can
+be measured without paying for API calls.
+
+    python benchmark.py --sessions 20 --concurrency 5 --chat-latency 0.8 --tts-latency 0.5
+
+Reports time from theme selection to the first riddle, time per answer
+submission (end to end and inside the script), element deltas and bytes
+sent per submission and peak memory per session. Games are
+interleaved so many sessions share the app's process-wide caches and workers.
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import random
+import re
+import resource
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "escaperoom.py")
+THEMES = ["Mystery Mansion", "Ancient Ruins", "Space Odyssey", "Enchanted Forest"]
+WORDS = ["shadow", "lantern", "mirror", "clock", "river", "crown", "feather", "anchor", "candle", "compass",
+         "garden", "whisper", "bridge", "echo", "marble", "violin", "comet", "orchid", "tunnel", "harbor",
+         "silver", "thunder", "puzzle", "velvet", "falcon", "glacier", "meadow", "ember", "riddle", "scroll"]
+
+
+# Local stand-in for the OpenAI and ElevenLabs HTTP APIs
+class StubProviders:
+    def __init__(self, chat_latency=0.0, image_latency=0.0, tts_latency=0.0, tts_bytes=40000, image_size=1024,
+                 riddle_words=40):
+        self.chat_latency = chat_latency
+        self.image_latency = image_latency
+        self.tts_latency = tts_latency
+        self.tts_bytes = tts_bytes
+        self.riddle_words = riddle_words
+        self.counter = itertools.count(1)
+        self.calls = {"chat": 0, "image": 0, "tts": 0}
+        self.chat_tokens = 0
+        self.tts_characters = 0
+        self.lock = threading.Lock()
+        self.image = self._make_image(image_size)
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if self.path.endswith("/chat/completions"):
+                    stub._send(self, "application/json", stub.chat(body))
+                elif self.path.endswith("/images/generations"):
+                    stub._send(self, "application/json", stub.image_generation())
+                elif "/text-to-speech/" in self.path:
+                    stub._send(self, "audio/mpeg", stub.speech(self.path, body))
+                else:
+                    self.send_error(404)
+
+            def do_GET(self):
+                stub._send(self, "image/png", stub.image)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def _make_image(self, size):
+        from PIL import Image
+        buffer = io.BytesIO()
+        pixels = bytes(random.Random(size).getrandbits(8) for _ in range(size * size * 3))
+        Image.frombytes("RGB", (size, size), pixels).save(buffer, "PNG")
+        return buffer.getvalue()
+
+    def _send(self, handler, content_type, data):
+        handler.send_response(200)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def _count(self, kind, tokens=0, characters=0):
+        with self.lock:
+            self.calls[kind] += 1
+            self.chat_tokens += tokens
+            self.tts_characters += characters
+
+    def _words(self, rng, count):
+        return " ".join(rng.choice(WORDS) for _ in range(count))
+
+    def _riddle(self, rng, n):
+        return {"riddle": f"{self._words(rng, self.riddle_words)} number {n}?", "answer": f"answer{n}",
+                "hint": self._words(rng, 12)}
+
+    def chat(self, body):
+        time.sleep(self.chat_latency)
+        prompt = "\n".join(message["content"] for message in body["messages"])
+        n = next(self.counter)
+        rng = random.Random(n)
+        if body.get("response_format"):
+            # Structured mode: the prompt says how many riddles it wants
+            count = int(re.search(r"exactly (\d+) riddles", prompt).group(1))
+            riddles = [dict(location=f"Room {i}: {self._words(rng, 12)}", **self._riddle(rng, f"{n}-{i}"))
+                       for i in range(1, count + 1)]
+            payload = {"riddles": riddles}
+            if "main_story" in prompt and "Story:" not in prompt:
+                payload = {"main_story": self._words(rng, 60), "riddles": riddles}
+            content = json.dumps(payload)
+        elif "storyline" in prompt:
+            count = int(re.search(r"connect (\d+) different", prompt).group(1))
+            content = "Main_Story: " + self._words(rng, 60) + "\n" + "\n".join(
+                f"Location_{i}: Room {i}: {self._words(rng, 12)}" for i in range(1, count + 1))
+        else:
+            riddle = self._riddle(rng, n)
+            content = f"Riddle: {riddle['riddle']}\nAnswer: {riddle['answer']}\nHint: {riddle['hint']}"
+        usage = {"prompt_tokens": len(prompt.split()), "completion_tokens": len(content.split())}
+        self._count("chat", usage["prompt_tokens"] + usage["completion_tokens"])
+        completion = {
+            "id": f"chatcmpl-{n}", "object": "chat.completion", "created": int(time.time()), "model": body.get("model", ""),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": dict(usage, total_tokens=usage["prompt_tokens"] + usage["completion_tokens"])
+        }
+        return json.dumps(completion).encode()
+
+    def image_generation(self):
+        self._count("image")
+        time.sleep(self.image_latency)
+        return json.dumps({"created": int(time.time()), "data": [{"url": f"{self.url}/image-{next(self.counter)}.png"}]}).encode()
+
+    def speech(self, path, body):
+        self._count("tts", characters=len(body.get("text", "")))
+        time.sleep(self.tts_latency)
+        # tts_bytes is the size at the API default of 128 kbps; other output formats scale with their bitrate
+        bitrate = re.search(r"output_format=\w+_(\d+)$", path)
+        size = self.tts_bytes * int(bitrate.group(1)) // 128 if bitrate else self.tts_bytes
+        # MPEG-1 Layer III frame headers followed by silence, sized like a real clip
+        frame = b"\xff\xfb\x90\x64" + b"\x00" * 413
+        seed = body.get("text", "").encode()[:64].ljust(64, b"\x00")
+        return (frame * (size // len(frame) + 1))[:max(size - len(seed), 0)] + seed
+
+
+# Time spent running the script and element deltas queued for the browser since the last reset. AppTest
+# runs one script at a time, so the totals between two resets belong to one rerun (and any st.rerun() it
+# triggers); unlike the wall time around AppTest.run() they leave out AppTest's own setup. The script is
+# compiled once and reused, as the server does, instead of on every AppTest run.
+RERUN = {"seconds": 0.0, "deltas": 0, "bytes": 0}
+
+
+def measure_reruns():
+    from streamlit.runtime.forward_msg_queue import ForwardMsgQueue
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.runtime.scriptrunner.script_runner import ScriptRunner
+
+    enqueue = ForwardMsgQueue.enqueue
+    run_script = ScriptRunner._run_script
+    get_bytecode = ScriptCache.get_bytecode
+    bytecode = {}
+
+    def counting_enqueue(self, msg):
+        if msg.HasField("delta"):
+            RERUN["deltas"] += 1
+            RERUN["bytes"] += msg.ByteSize()
+        enqueue(self, msg)
+
+    def timed_run_script(self, rerun_data):
+        start = time.perf_counter()
+        try:
+            run_script(self, rerun_data)
+        finally:
+            RERUN["seconds"] += time.perf_counter() - start
+
+    def shared_bytecode(self, script_path):
+        if script_path not in bytecode:
+            bytecode[script_path] = get_bytecode(self, script_path)
+        return bytecode[script_path]
+
+    ForwardMsgQueue.enqueue = counting_enqueue
+    ScriptRunner._run_script = timed_run_script
+    ScriptCache.get_bytecode = shared_bytecode
+
+
+def reset_rerun():
+    RERUN.update(seconds=0.0, deltas=0, bytes=0)
+
+
+# Rerun after a widget change, scoped the way the browser scopes it. AppTest always reruns the whole
+# script, so for "fragment" its runner's queued full rerun is replaced by one tagged with the fragment the
+# widget belongs to (the app has one), as the browser sends for input inside an st.fragment.
+def rerun(at, element, scope):
+    from dataclasses import replace
+    from streamlit.runtime.scriptrunner_utils.script_requests import ScriptRequests
+    from streamlit.testing.v1.local_script_runner import LocalScriptRunner
+
+    reset_rerun()
+    fragment_ids = list(at._fragment_storage._fragments)
+    if scope == "app" or not fragment_ids:
+        element.run()
+        return
+    request_rerun = LocalScriptRunner.request_rerun
+
+    def request_fragment_rerun(self, rerun_data):
+        self._requests = ScriptRequests()
+        return request_rerun(self, replace(rerun_data, fragment_id=fragment_ids[-1]))
+
+    LocalScriptRunner.request_rerun = request_fragment_rerun
+    try:
+        element.run()
+    finally:
+        LocalScriptRunner.request_rerun = request_rerun
+
+
+# Play one full game, yielding after every rerun so several games can be interleaved
+def play_session(result, theme, audio, wrong_answers, timeout, scope):
+    from streamlit.testing.v1 import AppTest
+
+    result.update({"submissions": [], "submission_script": [], "submission_deltas": [], "submission_bytes": [],
+                   "completed": False, "exceptions": []})
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout).run()
+    if not audio:
+        at.toggle[0].set_value(False).run()
+    yield
+
+    reset_rerun()
+    start = time.perf_counter()
+    at.selectbox[0].select(theme).run()
+    result["first_riddle"] = time.perf_counter() - start
+    result["first_riddle_bytes"] = RERUN["bytes"]
+    yield
+
+    while at.text_input and not at.session_state["game_completed"] and not at.exception:
+        riddle = at.session_state["riddles"][at.session_state["current_riddle_index"]]
+        answers = ["not it"] * wrong_answers + [riddle["answer"].split(",")[0]]
+        for answer in answers:
+            start = time.perf_counter()
+            rerun(at, at.text_input[0].input(answer), scope)
+            result["submissions"].append(time.perf_counter() - start)
+            result["submission_script"].append(RERUN["seconds"])
+            result["submission_deltas"].append(RERUN["deltas"])
+            result["submission_bytes"].append(RERUN["bytes"])
+            yield
+    result["completed"] = bool(at.session_state["game_completed"])
+    result["exceptions"] = [e.value for e in at.exception]
+    result["audio_bytes"] = audio_bytes(at.session_state["audio_cache"].values())
+
+
+# Size of the published clips behind a session's audio references
+def audio_bytes(refs):
+    audio_dir = os.path.join(os.environ["MINDVAULT_STATIC_DIR"], "audio")
+    names = os.listdir(audio_dir) if os.path.isdir(audio_dir) else []
+    return sum(os.path.getsize(os.path.join(audio_dir, name)) for ref in refs for name in names
+               if os.path.splitext(name)[0] == ref or name == ref)
+
+
+# Run games round-robin, keeping `concurrency` of them in progress at once. AppTest is not thread-safe,
+# so script runs are interleaved in one thread while the app's own background work runs concurrently.
+def run_sessions(themes, concurrency, audio, wrong_answers, timeout, scope):
+    results = [{} for _ in themes]
+    waiting = [play_session(result, theme, audio, wrong_answers, timeout, scope)
+               for result, theme in zip(results, themes)]
+    active = []
+    while waiting or active:
+        while waiting and len(active) < concurrency:
+            active.append(waiting.pop(0))
+        for session in list(active):
+            if next(session, StopIteration) is StopIteration:
+                active.remove(session)
+    return results
+
+
+def summarize(values, scale=1.0):
+    if not values:
+        return {}
+    ordered = sorted(values)
+    return {"mean": statistics.mean(ordered) * scale, "p50": ordered[len(ordered) // 2] * scale,
+            "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * scale, "max": ordered[-1] * scale}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sessions", type=int, default=8, help="games to play and time")
+    parser.add_argument("--concurrency", type=int, default=4, help="games played at the same time")
+    parser.add_argument("--chat-latency", type=float, default=0.3, help="seconds per chat completion")
+    parser.add_argument("--image-latency", type=float, default=1.0, help="seconds per image generation")
+    parser.add_argument("--tts-latency", type=float, default=0.3, help="seconds per TTS request")
+    parser.add_argument("--tts-bytes", type=int, default=40000, help="size of each synthesized clip at 128 kbps")
+    parser.add_argument("--audio-profile", default="standard", help="narration profile the sessions use")
+    parser.add_argument("--image-size", type=int, default=256, help="width and height of the generated image")
+    parser.add_argument("--riddle-words", type=int, default=40, help="words per generated riddle")
+    parser.add_argument("--wrong-answers", type=int, default=1, help="wrong submissions before each correct one")
+    parser.add_argument("--no-audio", action="store_true", help="play with narration turned off")
+    parser.add_argument("--num-riddles", type=int, default=4, help="riddles per adventure")
+    parser.add_argument("--riddles-ahead", type=int, default=2, help="riddles generated past the one being solved")
+    parser.add_argument("--generation-mode", choices=["text", "structured"], default="text",
+                        help="one chat call per riddle, or the whole adventure as one JSON call")
+    parser.add_argument("--rerun-scope", choices=["fragment", "app"], default="fragment",
+                        help="rerun only the riddle fragment after a submission, as the browser does, or the whole script")
+    parser.add_argument("--pool", type=int, default=0, help="adventure pool high watermark (0 disables the pool)")
+    parser.add_argument("--timeout", type=float, default=120, help="AppTest timeout per rerun")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    stub = StubProviders(args.chat_latency, args.image_latency, args.tts_latency, args.tts_bytes, args.image_size,
+                         args.riddle_words)
+    data_dir = tempfile.mkdtemp(prefix="mindvault-bench-")
+    os.environ.update({
+        "OPENAI_API_KEY": "bench", "OPENAI_BASE_URL": f"{stub.url}/v1",
+        "ELEVENLABS_API_KEY": "bench", "ELEVENLABS_API_URL": f"{stub.url}/v1",
+        "MINDVAULT_DATA_DIR": data_dir, "MINDVAULT_STATIC_DIR": os.path.join(data_dir, "static"),
+        "ADVENTURE_POOL_HIGH_WATERMARK": str(args.pool),
+        "GENERATION_MODE": args.generation_mode,
+        "NUM_RIDDLES": str(args.num_riddles), "RIDDLES_AHEAD": str(args.riddles_ahead),
+        "AUDIO_PROFILE_DESKTOP": args.audio_profile,
+    })
+
+    # Render the start page once so module imports do not count towards session memory
+    from streamlit.testing.v1 import AppTest
+    measure_reruns()
+    AppTest.from_file(APP_PATH, default_timeout=args.timeout).run()
+
+    # Memory: one game traced on its own (tracing slows everything down, so it is not timed)
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    run_sessions(THEMES[:1], 1, not args.no_audio, args.wrong_answers, args.timeout, args.rerun_scope)
+    single_session_peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+
+    # Timing: all games together, sharing the process-wide caches like sessions on one server
+    for kind in stub.calls:
+        stub.calls[kind] = 0
+    stub.chat_tokens = 0
+    stub.tts_characters = 0
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    themes = [THEMES[i % len(THEMES)] for i in range(args.sessions)]
+    results = run_sessions(themes, args.concurrency, not args.no_audio, args.wrong_answers, args.timeout,
+                           args.rerun_scope)
+    wall_time = time.perf_counter() - start
+    rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+
+    report = {
+        "sessions": len(results),
+        "completed": sum(r["completed"] for r in results),
+        "exceptions": [e for r in results for e in r["exceptions"]],
+        "theme_to_first_riddle_ms": summarize([r["first_riddle"] for r in results if "first_riddle" in r], 1000),
+        "answer_submission_ms": summarize([t for r in results for t in r["submissions"]], 1000),
+        "submission_script_ms": summarize([t for r in results for t in r["submission_script"]], 1000),
+        "first_riddle_bytes": summarize([r["first_riddle_bytes"] for r in results if "first_riddle_bytes" in r]),
+        "deltas_per_submission": summarize([d for r in results for d in r["submission_deltas"]]),
+        "bytes_per_submission": summarize([b for r in results for b in r["submission_bytes"]]),
+        "audio_bytes_per_session": summarize([r["audio_bytes"] for r in results if "audio_bytes" in r]),
+        "peak_memory_single_session_kb": single_session_peak / 1024,
+        "peak_rss_growth_per_concurrent_session_kb": rss_growth / max(1, min(args.concurrency, args.sessions)),
+        "concurrent_wall_time_s": wall_time,
+        "provider_calls": dict(stub.calls),
+        "chat_tokens_per_session": stub.chat_tokens / max(1, len(results)),
+        "tts_characters_per_session": stub.tts_characters / max(1, len(results)),
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"Sessions: {report['sessions']} ({report['completed']} completed, concurrency {args.concurrency})")
+    for name, unit in (("theme_to_first_riddle_ms", "ms"), ("answer_submission_ms", "ms"),
+                       ("submission_script_ms", "ms"), ("first_riddle_bytes", "B"),
+                       ("deltas_per_submission", ""), ("bytes_per_submission", "B"), ("audio_bytes_per_session", "B")):
+        stats = report[name]
+        print(f"{name:28} " + "  ".join(f"{key} {value:10.1f}{unit}" for key, value in stats.items()))
+    print(f"{'peak memory, one session':28} {report['peak_memory_single_session_kb']:10.1f} KB")
+    print(f"{'peak RSS growth per session':28} {report['peak_rss_growth_per_concurrent_session_kb']:10.1f} KB (concurrent)")
+    print(f"{'provider calls':28} {report['provider_calls']}")
+    print(f"{'chat tokens per session':28} {report['chat_tokens_per_session']:10.1f}")
+    print(f"{'TTS characters per session':28} {report['tts_characters_per_session']:10.1f}")
+    if report["exceptions"]:
+        print(f"Exceptions: {report['exceptions'][:5]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,318 +1,71 @@
-import openai
-from openai import OpenAI
 import streamlit as st
 import os
 import time
-import datetime
-import requests
-import base64
-
-# Initialize OpenAI API client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-ELEVENLABS_API_KEY = os.getenv("ELEVENLABS_API_KEY")
-ELEVENLABS_VOICE_ID = "N2lVS1w4EtoT3dr4eOWO"
-
-# Function to generate storyline and connected riddles
-def generate_escape_room_adventure(theme, num_riddles=4):
-    # Create a storyline that connects all riddles
-    storyline_prompt = f"""Create a short, engaging escape room storyline related to the theme: {theme}.
-    The story should connect {num_riddles} different locations or challenges, each with its own riddle.
-    Make the storyline cohesive but each location/challenge distinct.
-    Format your response as:
-    Main_Story: [brief overall story]
-    Location_1: [first location name: challenge description]
-    Location_2: [second location name: challenge description]
-    Location_3: [third location name: challenge description]
-    Location_4: [fourth location name: challenge description]"""
-    
-    story_response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "system", "content": "You are creating an immersive escape room adventure."},
-                  {"role": "user", "content": storyline_prompt}],
-        temperature=0.7,
-        max_tokens=500
-    )
-    
-    storyline_result = story_response.choices[0].message.content.strip()
-    
-    # Parse storyline sections
-    story_sections = {"Main_Story": ""}
-    current_section = "Main_Story"
-    
-    for line in storyline_result.split('\n'):
-        if any(f"Location_{i}:" in line for i in range(1, num_riddles+1)):
-            current_section = line.split(':')[0].strip()
-            story_sections[current_section] = line.split(':', 1)[1].strip() if ':' in line else ""
-        elif "Main_Story:" in line:
-            current_section = "Main_Story"
-            story_sections[current_section] = line.split(':', 1)[1].strip() if ':' in line else ""
-        else:
-            story_sections[current_section] += " " + line.strip()
-    
-    # Generate distinct riddles for each location
-    riddles = []
-    for i in range(1, num_riddles+1):
-        location_key = f"Location_{i}"
-        location = story_sections.get(location_key, f"Challenge {i}")
-        
-        # Create a prompt that ensures the riddles are different
-        previous_riddles = ""
-        if riddles:
-            previous_riddles = "Previous riddles generated (make this one different):\n"
-            for j, prev_riddle in enumerate(riddles):
-                previous_riddles += f"Riddle {j+1}: {prev_riddle['riddle']}\n"
-        
-        riddle_prompt = f"""Create a fun and engaging riddle for this escape room location: {location}
-        The theme is: {theme}
-        The riddle should be tricky but solvable and MUST BE DIFFERENT from any previous riddles.
-        {previous_riddles}
-        Format your response as:
-        Riddle: [your riddle here]
-        Answer: [clear answer]
-        Hint: [specific, helpful hint]"""
-        
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "system", "content": "You are creating unique, challenging riddles for each part of an escape room."},
-                      {"role": "user", "content": riddle_prompt}],
-            temperature=0.8,
-            max_tokens=250
-        )
-        
-        result = response.choices[0].message.content.strip()
-        
-        # Parse riddle, answer, and hint
-        riddle_parts = {}
-        current_part = None
-        
-        for line in result.split('\n'):
-            if line.startswith('Riddle:'):
-                current_part = 'riddle'
-                riddle_parts[current_part] = line.replace('Riddle:', '').strip()
-            elif line.startswith('Answer:'):
-                current_part = 'answer'
-                riddle_parts[current_part] = line.replace('Answer:', '').strip().lower()
-            elif line.startswith('Hint:'):
-                current_part = 'hint'
-                riddle_parts[current_part] = line.replace('Hint:', '').strip()
-            elif current_part:
-                riddle_parts[current_part] += ' ' + line.strip()
-        
-        riddles.append({
-            "location": location,
-            "riddle": riddle_parts.get('riddle', "A challenging riddle awaits..."),
-            "answer": riddle_parts.get('answer', "unknown"),
-            "hint": riddle_parts.get('hint', "Look carefully at the wording of the riddle.")
-        })
-    
-    return story_sections["Main_Story"], riddles
-
-# Function to generate images using DALL·E
-def generate_image(theme):
-    response = client.images.generate(
-        prompt=f"Create an immersive {theme} setting, with rich details and light colors suitable for a background for an escape room.",
-        n=1,
-        size="1024x1024"
-    )
-    image_url = response.data[0].url
-    return image_url
-
-# ElevenLabs TTS Function
-def text_to_speech(text):
-    url = f"https://api.elevenlabs.io/v1/text-to-speech/{ELEVENLABS_VOICE_ID}"
-    headers = {"xi-api-key": ELEVENLABS_API_KEY, "Content-Type": "application/json"}
-    data = {
-        "text": text,
-        "model_id": "eleven_monolingual_v1",
-        "voice_settings": {
-            "stability": 0.5,
-            "similarity_boost": 0.8
-        }
-    }
-    
-    try:
-        response = requests.post(url, json=data, headers=headers)
-        response.raise_for_status()  # Raise exception for non-200 status codes
-        return response.content
-    except requests.exceptions.RequestException as e:
-        st.error(f"Error calling ElevenLabs API: {e}")
-        return None
+import re
+import hashlib
+import json
+import io
+import uuid
+import secrets
+import cProfile
+import pstats
+from mindvault import (
+    ADVENTURE_POOL_HOLDER, APP_STATIC_DIR, AUDIO_PROFILES, AUDIO_PROFILE_DESKTOP, AUDIO_PROFILE_MOBILE, CORRECT_TEXT,
+    ELEVENLABS_API_KEY, GAME_STATE_KEYS, IMAGE_WIDTHS, MEMORY_STATS_VIEW, NUM_RIDDLES, PREFETCH_MAX_IN_FLIGHT,
+    PROFILE_RERUNS, RIDDLES_AHEAD, SECONDS_PER_RIDDLE, STATIC_AUDIO_URL, STATIC_IMAGE_URL, THEMES,
+    TIMES_UP_TEXT, TTS_STREAMING, VICTORY_TEXT, WRONG_MESSAGES,
+    NarrationPrefetcher, answer_matches, audio_file_name, audio_mime_type, build_answer_index, call_context,
+    current_audio_profile, get_adventure_pool, get_blob_store, get_game_store, get_generation_executor, get_metrics,
+    get_narration_stream_server, get_published_audio, get_tts_breaker, hint_narration_segments, metrics_logger,
+    narration_to_speech, prewarm_fixed_phrases, riddle_narration, riddle_narration_segments,
+    start_adventure_pipeline, text_to_speech
+)
+
+# Audio player that starts playing while the narration is still being synthesized
+def get_streaming_audio_player(text):
+    profile = current_audio_profile()
+    url = get_narration_stream_server().url_for(text, profile)
+    return f'<audio autoplay controls preload="auto"><source src="{url}" type="{AUDIO_PROFILES[profile]["mime_type"]}"></audio>'
 
-# Function to create an audio player with the audio data
-def get_audio_player(audio_data):
-    if audio_data:
-        b64 = base64.b64encode(audio_data).decode()
-        return f'<audio autoplay controls><source src="data:audio/mp3;base64,{b64}" type="audio/mp3"></audio>'
+# Function to create an audio player for a stored clip reference
+def get_audio_player(audio_ref):
+    if audio_ref:
+        return f'<audio autoplay controls preload="auto"><source src="{STATIC_AUDIO_URL}/{audio_file_name(audio_ref)}" type="{audio_mime_type(audio_ref)}"></audio>'
     return ""
 
-# Function to set CSS styles including the background image
-def set_styles(image_url):
-    st.markdown(
-        f"""
-        <style>
-        .stApp {{
-        background-image: url("{image_url}");
-        background-size: cover;
-        background-position: center;
-        background-repeat: no-repeat;
-        }}
+# Version the stylesheet URL by its contents so browsers can cache it until it changes
+@st.cache_resource
+def stylesheet_url():
+    with open(os.path.join(APP_STATIC_DIR, "mindvault.css"), "rb") as f:
+        return f"app/static/mindvault.css?v={hashlib.sha256(f.read()).hexdigest()[:12]}"
 
-        .game-container {{
-            background-color: rgba(255, 255, 255, 0.92);
-            padding: 25px;
-            border-radius: 12px;
-            margin: 20px 0;
-            box-shadow: 0 6px 12px rgba(0, 0, 0, 0.15);
-        }}
-        .story-box {{
-            background-color: white;
-            padding: 20px;
-            border-radius: 8px;
-            border-left: 5px solid #ff444c;
-            margin: 15px 0;
-            box-shadow: 0 3px 7px rgba(0, 0, 0, 0.1);
-        }}
-        .riddle-box {{
-            background-color: white;
-            padding: 20px;
-            border-radius: 8px;
-            border-left: 5px solid #ff4b4b;
-            margin: 15px 0;
-            box-shadow: 0 3px 7px rgba(0, 0, 0, 0.1);
-        }}
-        .hint-box {{
-            background-color: white;
-            padding: 20px;
-            border-radius: 8px;
-            border-left: 5px solid #ffcc00;
-            margin: 15px 0;
-            box-shadow: 0 3px 7px rgba(0, 0, 0, 0.1);
-        }}
-        .timer-box {{
-            font-size: 24px;
-            font-weight: bold;
-            padding: 12px;
-            border-radius: 8px;
-            text-align: center;
-            margin: 15px 0;
-            box-shadow: 0 3px 7px rgba(0, 0, 0, 0.2);
-        }}
-        .timer-mystery {{
-            background-color: #3a163d;
-            color: #f2ce1b;
-            border: 2px solid #6b2e70;
-        }}
-        .timer-ruins {{
-            background-color: #7e6339;
-            color: #e3dac9;
-            border: 2px solid #594729;
-        }}
-        .timer-space {{
-            background-color: #0c164f;
-            color: #00ffff;
-            border: 2px solid #273c75;
-        }}
-        .timer-forest {{
-            background-color: #1e4d2b;
-            color: #b6ff9c;
-            border: 2px solid #3e7e46;
-        }}
-        .progress-bar {{
-            background-color: #f0f0f0;
-            border-radius: 8px;
-            padding: 3px;
-            margin: 15px 0;
-            box-shadow: 0 3px 7px rgba(0, 0, 0, 0.1);
-        }}
-        .progress-fill {{
-            background-color: #4CAF50;
-            height: 24px;
-            border-radius: 5px;
-            text-align: center;
-            line-height: 24px;
-            color: white;
-            font-weight: bold;
-            transition: width 0.3s;
-        }}
-        .game-title {{
-            font-family: 'Trebuchet MS', sans-serif;
-            text-align: center;
-            font-size: 52px;
-            font-weight: bold;
-            color: #1a1a1a;
-            text-shadow: 2px 2px 4px rgba(0, 0, 0, 0.4), 0 0 10px rgba(255, 255, 255, 0.5);
-            letter-spacing: 2px;
-        }}
-        .game-sub-title {{
-            font-family: 'Trebuchet MS', sans-serif;
-            text-align: center;
-            font-size: 20px;
-            color: #1a1a1a;
-            text-shadow: 2px 2px 4px rgba(0, 0, 0, 0.4), 0 0 10px rgba(255, 255, 255, 0.5);
-        }}
-        .high-contrast-text {{
-            color: black;
-            text-shadow: 
-                0px 0px 3px white,
-                0px 0px 6px white,
-                0px 0px 9px white;
-            font-weight: bold;
-        }}
-        .centered-button {{
-            display: flex;
-            justify-content: center;
-            margin: 20px 0;
-        }}
-        .stButton > button {{
-            font-weight: bold;
-            padding: 10px 25px;
-            border-radius: 6px;
-        }}
-        /* Improve reset button position */
-        .reset-button-container {{
-            position: absolute;
-            top: 20px;
-            right: 30px;
-        }}
-        /* Hide empty text area */
-        .stTextArea, .stText {{
-            display: none;
-        }}
-        /* Theme selector styling */
-        .stSelectbox [data-baseweb=select] {{
-            background-color: white;
-        }}
-        /* User input styling */
-        .stTextInput > div > div > input {{
-            border: 2px solid #4a4a4a;
-            font-size: 18px;
-            padding: 8px 12px;
-        }}
-        .error-message{{
-            padding: 10px;
-            border-radius: 5px;
-            background-color: #FF7F7F;
-            color: #800000; 
-            font-weight: bold;
-        }}
-        .audio-player {{
-            margin: 15px 0;
-        }}
-        .audio-controls {{
-            display: flex;
-            align-items: center;
-            justify-content: space-between;
-            background-color: #f0f0f0;
-            padding: 10px;
-            border-radius: 8px;
-            margin-top: 10px;
-        }}
-        .audio-options {{
-            display: flex;
-            gap: 10px;
-        }}
-        </style>
-        """,
+# Root-relative URL for a file served by this app. Relative URLs inside CSS variables would resolve
+# against the stylesheet that reads them rather than the page.
+def app_url(path):
+    base_path = st.get_option("server.baseUrlPath").strip("/")
+    return f"/{base_path}/{path}" if base_path else f"/{path}"
+
+# CSS image-set() preferring WebP with a JPEG fallback for one cached image width
+def image_set_css(image_url, width):
+    return f'image-set(url("{app_url(f"{image_url}/{width}.webp")}") type("image/webp"), url("{app_url(f"{image_url}/{width}.jpg")}") type("image/jpeg"))'
+
+# Background variables read by the stylesheet; cached images also get a smaller variant for small screens
+def background_variables(image_url):
+    if not image_url:
+        return ""
+    if not image_url.startswith(STATIC_IMAGE_URL):
+        return f'--mv-background-fallback: url("{image_url}");'
+    small, large = IMAGE_WIDTHS[0], IMAGE_WIDTHS[-1]
+    return (f'--mv-background: {image_set_css(image_url, large)}; '
+            f'--mv-background-fallback: url("{app_url(f"{image_url}/{large}.jpg")}"); '
+            f'--mv-background-small: {image_set_css(image_url, small)}; '
+            f'--mv-background-small-fallback: url("{app_url(f"{image_url}/{small}.jpg")}");')
+
+# Function to set CSS styles including the background image. The static rules come from the cached
+# stylesheet; only the background variables change, and later calls replace the block in place.
+def set_styles(image_url):
+    styles_placeholder.markdown(
+        f'<style>@import url("{stylesheet_url()}"); :root {{ {background_variables(image_url)} }}</style>',
         unsafe_allow_html=True
     )
 
@@ -334,13 +87,401 @@ def get_timer_class(theme):
     else:
         return "timer-mystery"  # default
 
+# Countdown that runs in the browser from the remaining time issued by the server, so the clock keeps
+# moving without reruns. The server still enforces the deadline when an answer is submitted.
+def render_countdown(remaining, timer_class):
+    st.iframe(
+        f"""
+        <link rel="stylesheet" href="{app_url(stylesheet_url())}">
+        <style>body {{ margin: 0; background: transparent; font-family: sans-serif; }} .timer-box {{ margin: 3px; }}</style>
+        <div class="timer-box {timer_class}" id="timer">Time Remaining: {format_time(remaining)}</div>
+        <script>
+        const end = Date.now() + {remaining * 1000};
+        const timer = document.getElementById("timer");
+        const pad = (n) => String(n).padStart(2, "0");
+        function tick() {{
+            const left = Math.max(0, Math.ceil((end - Date.now()) / 1000));
+            timer.textContent = left > 0
+                ? `Time Remaining: ${{pad(Math.floor(left / 60))}}:${{pad(left % 60)}}`
+                : "Time's up!";
+            if (left > 0) setTimeout(tick, 250);
+        }}
+        tick();
+        </script>
+        """,
+        height=70
+    )
+
+# Keep a clip in the shared blob store and remember only its reference in the session
+def store_session_audio(key, audio):
+    ref = get_blob_store().put(st.session_state.session_id, audio)
+    st.session_state.audio_cache[key] = ref
+    st.session_state.current_audio = ref
+
+# Drop the session's clip references
+def clear_session_audio():
+    get_blob_store().release(st.session_state.session_id)
+    st.session_state.audio_cache = {}
+    st.session_state.current_audio = None
+
+# Check whether the session's generation pipeline still has the given stage outstanding
+def pipeline_pending(name):
+    pipeline = st.session_state.get("pipeline")
+    return pipeline is not None and pipeline.has(name)
+
+# Copy finished pipeline stages into the session; optionally wait for one stage first
+def sync_pipeline(wait_for=None):
+    pipeline = st.session_state.pipeline
+    if pipeline is None:
+        return
+    
+    # Let generation run up to RIDDLES_AHEAD riddles past the one being solved
+    for i in range(st.session_state.current_riddle_index + 1):
+        pipeline.open(f"reached_{i}")
+    
+    if wait_for and pipeline.has(wait_for):
+        try:
+            pipeline.result(wait_for)
+        except Exception:
+            pass  # Reported below when the stage is taken
+    
+    # Riddles are added in order, so a late riddle never leaves a gap
+    riddles = st.session_state.riddles
+    while pipeline.ready(f"riddle_{len(riddles)}"):
+        try:
+            riddles.append(pipeline.take(f"riddle_{len(riddles)}"))
+        except Exception as e:
+            st.error(f"Error generating adventure: {str(e)}")
+            st.session_state.total_riddles = len(riddles)
+            pipeline.cancel()
+            # A player waiting on the failed riddle cannot go on; the error stays on the page that ends the game
+            if st.session_state.current_riddle_index >= len(riddles):
+                st.session_state.game_ended_early = f"Error generating adventure: {str(e)}"
+            break
+    
+    if pipeline.ready("image"):
+        try:
+            st.session_state.current_image = pipeline.take("image")
+        except Exception as e:
+            st.error(f"Error generating image: {str(e)}")
+    
+    for name in [name for name in pipeline.futures if name.startswith("audio:") and pipeline.ready(name)]:
+        try:
+            audio = pipeline.take(name)
+        except Exception:
+            continue  # The page synthesizes it inline instead
+        if audio:
+            store_session_audio(name[len("audio:"):], audio)
+    
+    outstanding = [name for name in pipeline.futures if name == "image" or name.startswith("audio:")]
+    if len(riddles) >= st.session_state.total_riddles and not outstanding:
+        st.session_state.pipeline = None
+
+# Pick the narration profile for this browser: compact speech audio for phones, fuller audio on desktop
+def client_audio_profile():
+    user_agent = st.context.headers.get("User-Agent", "") if st.context.headers else ""
+    return AUDIO_PROFILE_MOBILE if re.search(r"Mobi|Android|iPhone|iPad", user_agent) else AUDIO_PROFILE_DESKTOP
+
+# Give the game a token in the page URL so a refresh or reconnect can resume it
+def start_saved_game():
+    if st.session_state.get("game_token"):
+        get_game_store().delete(st.session_state.game_token)  # The game it replaces can no longer be resumed
+    st.session_state.game_token = secrets.token_urlsafe(16)
+    st.session_state.game_saved_digest = None
+    st.query_params["game"] = st.session_state.game_token
+
+# Save the game state if it changed since the last save
+def save_game():
+    token = st.session_state.get("game_token")
+    if not token or not st.session_state.riddles:
+        return
+    state = {key: st.session_state[key] for key in GAME_STATE_KEYS}
+    state["riddles"] = [{key: value for key, value in riddle.items() if key != "answer_index"} for riddle in state["riddles"]]
+    data = json.dumps(state, sort_keys=True)
+    digest = hashlib.sha256(data.encode()).hexdigest()
+    if digest != st.session_state.get("game_saved_digest"):
+        get_game_store().save(token, data)
+        st.session_state.game_saved_digest = digest
+
+# Restore a saved game into this session. Clips still in the published folder are re-referenced;
+# riddles that were still being generated are generated again.
+def resume_game(token):
+    state = get_game_store().load(token)
+    if state is None:
+        del st.query_params["game"]
+        return
+    
+    # Drop whatever this session was doing before: its pipeline, prefetches and clip holds
+    cancel_pipeline()
+    st.session_state.prefetcher.cancel()
+    clear_session_audio()
+    for key in GAME_STATE_KEYS:
+        st.session_state[key] = state.get(key)  # Games saved by older versions lack the newer keys
+    for riddle in st.session_state.riddles:
+        riddle["answer_index"] = build_answer_index(riddle["answer"], riddle.get("synonyms", []))
+    st.session_state.theme_index = THEMES.index(state["current_theme"]) + 1 if state["current_theme"] in THEMES else 0
+    st.session_state.game_token = token
+    st.session_state.game_saved_digest = None
+    
+    published = get_published_audio()
+    st.session_state.audio_cache = {}
+    for key, ref in state["audio_cache"].items():
+        if published.contains(ref):
+            get_blob_store().acquire(st.session_state.session_id, ref)
+            st.session_state.audio_cache[key] = ref
+    
+    if len(st.session_state.riddles) < st.session_state.total_riddles and st.session_state.locations:
+        st.session_state.pipeline = start_adventure_pipeline(
+            state["current_theme"], st.session_state.total_riddles, image=not state["current_image"],
+            storyline=(state["main_story"], state["locations"]), riddles=st.session_state.riddles,
+            narrate=session_narration(st.session_state.total_riddles, start=len(st.session_state.riddles)), ahead=RIDDLES_AHEAD)
+
+# Narration a game's pipeline synthesizes next to the text: the intro and every riddle from start on
+def session_narration(num_riddles, start=0):
+    if not st.session_state.audio_enabled or TTS_STREAMING:
+        return ()
+    return ("intro",) * (start == 0) + tuple(f"riddle_{i}" for i in range(start, num_riddles))
+
+# Stage names the page waits for at the end of a run: the background and the narration on screen now
+def awaited_stages(pipeline):
+    shown = ("image", "audio:intro", f"audio:riddle_{st.session_state.current_riddle_index}")
+    return [name for name in pipeline.futures if name in shown]
+
+# Stop the session's pipeline from starting any more stages
+def cancel_pipeline():
+    if st.session_state.get("pipeline"):
+        st.session_state.pipeline.cancel()
+    st.session_state.pipeline = None
+
+# Queue narration for the next riddle and the current hint while the player works on this riddle
+def prefetch_narration(riddle_index):
+    if not st.session_state.audio_enabled or get_tts_breaker().is_open():
+        return
+    prefetcher = st.session_state.prefetcher
+    riddles = st.session_state.riddles
+    if f"hint_{riddle_index}" not in st.session_state.audio_cache:
+        prefetcher.prefetch(f"hint_{riddle_index}", hint_narration_segments(riddles[riddle_index]))
+    if riddle_index + 1 < len(riddles) and f"riddle_{riddle_index + 1}" not in st.session_state.audio_cache and not pipeline_pending(f"audio:riddle_{riddle_index + 1}"):
+        prefetcher.prefetch(f"riddle_{riddle_index + 1}", riddle_narration_segments(riddles[riddle_index + 1]))
+
+# Function to draw the riddle progress bar
+def render_progress():
+    progress_percentage = (st.session_state.current_riddle_index / max(st.session_state.total_riddles, 1)) * 100
+    st.markdown(
+        f"""
+        <div class='progress-bar'>
+            <div class='progress-fill' style='width: {progress_percentage}%;'>
+                {st.session_state.current_riddle_index}/{st.session_state.total_riddles} Riddles
+            </div>
+        </div>
+        """, 
+        unsafe_allow_html=True
+    )
+
+# Function to check a submitted answer and move the game on. Returns the key of the feedback clip to play.
+def check_answer(current_riddle, user_answer):
+    # Check the answer against the index built when the riddle was generated
+    answer_index = current_riddle.get("answer_index") or build_answer_index(current_riddle["answer"])
+    
+    if answer_matches(answer_index, user_answer):
+        # Generate correct answer audio
+        if st.session_state.audio_enabled and "correct_answer" not in st.session_state.audio_cache:
+            with st.spinner("Generating audio..."):
+                correct_audio = text_to_speech(CORRECT_TEXT)
+                if correct_audio:
+                    store_session_audio("correct_answer", correct_audio)
+        
+        # Move to the next riddle
+        st.session_state.current_riddle_index += 1
+        st.session_state.wrong_attempts = 0  # Reset wrong attempts for next riddle
+        st.session_state.previous_answer = ""  # Reset previous answer
+        st.session_state.error_message = ""   # Clear error message
+        st.session_state.show_hint = False    # Hide hint for next riddle
+            
+        # Check if all riddles are completed
+        if st.session_state.current_riddle_index >= st.session_state.total_riddles:
+            st.session_state.game_completed = True
+        return None
+    
+    # Wrong answer
+    st.session_state.wrong_attempts += 1
+    
+    # Generate wrong answer audio if not already cached
+    wrong_audio_key = f"wrong_{min(st.session_state.wrong_attempts, 3)}"
+    if st.session_state.audio_enabled and wrong_audio_key not in st.session_state.audio_cache:
+        wrong_text = WRONG_MESSAGES[min(st.session_state.wrong_attempts, 3) - 1]
+        with st.spinner("Generating audio..."):
+            wrong_audio = text_to_speech(wrong_text)
+            if wrong_audio:
+                store_session_audio(wrong_audio_key, wrong_audio)
+    
+    # Set error message
+    if st.session_state.wrong_attempts >= 3:
+        st.session_state.error_message = "That's not correct. A hint has been provided above."
+        st.session_state.show_hint = True
+    else:
+        st.session_state.error_message = f"That's not correct. Try again! ({st.session_state.wrong_attempts}/3 attempts)"
+    return wrong_audio_key
+
+# The progress bar, story, riddle, hint and answer input. Submitting an answer reruns only this fragment,
+# so the title, theme picker, countdown and background are not rebuilt or resent. A submission is checked
+# before anything is drawn, which lets a wrong answer or the next riddle show without a second run.
+@st.fragment
+def riddle_area():
+    fragment_started = time.perf_counter()
+    call_context.audio_profile = st.session_state.audio_profile
+    
+    # Check a newly submitted answer (the input's value arrives before the input is drawn again)
+    feedback_audio_key = None
+    user_answer = st.session_state.get(f"answer_input_{st.session_state.current_riddle_index}", "")
+    if user_answer and user_answer != st.session_state.previous_answer and st.session_state.current_riddle_index < len(st.session_state.riddles):
+        # Store current answer to detect changes
+        st.session_state.previous_answer = user_answer
+        
+        # The countdown only runs in the browser, so check the deadline before accepting the answer
+        if time.time() >= st.session_state.start_time + st.session_state.time_limit:
+            st.rerun()
+        
+        feedback_audio_key = check_answer(st.session_state.riddles[st.session_state.current_riddle_index], user_answer)
+        save_game()
+        
+        # The completion screen replaces the whole page
+        if st.session_state.game_completed:
+            st.rerun()
+    
+    render_progress()
+    
+    # Display main story only on the first riddle
+    if st.session_state.current_riddle_index == 0 and st.session_state.main_story:
+        st.markdown(f"<div class='story-box'><h3>Your Adventure Begins:</h3>{st.session_state.main_story}</div>", unsafe_allow_html=True)
+        
+        # Display audio player for main story
+        if st.session_state.audio_enabled and "intro" in st.session_state.audio_cache:
+            st.markdown(
+                f"<div class='audio-player'>{get_audio_player(st.session_state.audio_cache['intro'])}</div>",
+                unsafe_allow_html=True
+            )
+        elif st.session_state.audio_enabled and TTS_STREAMING and not get_tts_breaker().is_open():
+            st.markdown(
+                f"<div class='audio-player'>{get_streaming_audio_player(st.session_state.main_story)}</div>",
+                unsafe_allow_html=True
+            )
+        
+    # Wait for the current riddle if it is still being generated
+    if st.session_state.current_riddle_index >= len(st.session_state.riddles) and pipeline_pending(f"riddle_{st.session_state.current_riddle_index}"):
+        with st.spinner("Preparing the next riddle..."):
+            sync_pipeline(wait_for=f"riddle_{st.session_state.current_riddle_index}")
+        if st.session_state.game_ended_early:
+            st.rerun()
+    else:
+        sync_pipeline()  # Also lets the pipeline start on the riddles after this one
+    
+    # Display the current riddle if riddles exist
+    if st.session_state.riddles and st.session_state.current_riddle_index < len(st.session_state.riddles):
+        current_riddle = st.session_state.riddles[st.session_state.current_riddle_index]
+        
+        # Generate audio for current riddle if not already in cache
+        riddle_audio_key = f"riddle_{st.session_state.current_riddle_index}"
+        riddle_text = riddle_narration(current_riddle)
+        prefetcher = st.session_state.prefetcher
+        if st.session_state.audio_enabled and st.session_state.current_riddle_index > 0 and pipeline_pending(f"audio:{riddle_audio_key}"):
+            # Later riddles are narrated while the one before is solved, so this is usually done already
+            with st.spinner("Generating riddle narration..."):
+                sync_pipeline(wait_for=f"audio:{riddle_audio_key}")
+        if st.session_state.audio_enabled and riddle_audio_key not in st.session_state.audio_cache and (prefetcher.pending(riddle_audio_key) or not TTS_STREAMING) and not pipeline_pending(f"audio:{riddle_audio_key}"):
+            with st.spinner("Generating riddle narration..."):
+                riddle_audio = prefetcher.take(riddle_audio_key) if prefetcher.pending(riddle_audio_key) else narration_to_speech(riddle_narration_segments(current_riddle))
+                if riddle_audio:
+                    store_session_audio(riddle_audio_key, riddle_audio)
+        
+        # Display location story and riddle together
+        st.markdown(
+            f"""
+            <div class='riddle-box'>
+                <p class='location-story'>{current_riddle['location']}</p>
+                <h4>Riddle {st.session_state.current_riddle_index + 1} of {st.session_state.total_riddles}:</h4>
+                <p class='riddle-text'>{current_riddle['riddle']}</p>
+            </div>
+            """, 
+            unsafe_allow_html=True
+        )
+        
+        # Play riddle audio
+        if st.session_state.audio_enabled and riddle_audio_key in st.session_state.audio_cache:
+            st.markdown(
+                f"<div class='audio-player'>{get_audio_player(st.session_state.audio_cache[riddle_audio_key])}</div>",
+                unsafe_allow_html=True
+            )
+        elif st.session_state.audio_enabled and TTS_STREAMING and not get_tts_breaker().is_open():
+            st.markdown(
+                f"<div class='audio-player'>{get_streaming_audio_player(riddle_text)}</div>",
+                unsafe_allow_html=True
+            )
+        
+        # Prepare the narration the player is likely to need next
+        prefetch_narration(st.session_state.current_riddle_index)
+        
+        # Create error message container
+        error_placeholder = st.empty()
+
+        # Display hint if 3 or more wrong attempts
+        if st.session_state.wrong_attempts >= 3:
+            st.markdown(f"<div class='hint-box'><h3>Hint:</h3>{current_riddle['hint']}</div>", unsafe_allow_html=True)
+            
+            # Generate hint audio if not already cached
+            hint_audio_key = f"hint_{st.session_state.current_riddle_index}"
+            if st.session_state.audio_enabled and hint_audio_key not in st.session_state.audio_cache:
+                with st.spinner("Generating hint narration..."):
+                    if prefetcher.pending(hint_audio_key):
+                        hint_audio = prefetcher.take(hint_audio_key)
+                    else:
+                        hint_audio = narration_to_speech(hint_narration_segments(current_riddle))
+                    if hint_audio:
+                        store_session_audio(hint_audio_key, hint_audio)
+            
+            # Play hint audio
+            if st.session_state.audio_enabled and hint_audio_key in st.session_state.audio_cache:
+                st.markdown(
+                    f"<div class='audio-player'>{get_audio_player(st.session_state.audio_cache[hint_audio_key])}</div>",
+                    unsafe_allow_html=True
+                )
+        
+        # Use placeholder text in input box instead of label
+        st.text_input("User Answer", placeholder="Enter your answer here and press Enter...", key=f"answer_input_{st.session_state.current_riddle_index}", label_visibility="collapsed")
+
+        # Display any existing error message
+        if st.session_state.error_message:
+            error_placeholder.markdown(f"""
+            <div class="error-message">
+            {st.session_state.error_message}
+            </div>
+            """, unsafe_allow_html=True)
+        
+        # Play the feedback for the answer just submitted
+        if st.session_state.audio_enabled and feedback_audio_key in st.session_state.audio_cache:
+            st.markdown(
+                f"<div class='audio-player'>{get_audio_player(st.session_state.audio_cache[feedback_audio_key])}</div>",
+                unsafe_allow_html=True
+            )
+    
+    get_metrics().observe("mindvault_fragment_run_seconds", {}, time.perf_counter() - fragment_started)
+
 def reset_session():
+    cancel_pipeline()
+    clear_session_audio()
+    if st.session_state.get("prefetcher"):
+        st.session_state.prefetcher.cancel()
+    if st.session_state.get("game_token"):
+        get_game_store().delete(st.session_state.game_token)
     for key in list(st.session_state.keys()):
-        if key != 'audio_enabled':  # Preserve audio preference
+        if key not in ('audio_enabled', 'session_id'):  # Preserve audio preference and session identity
             del st.session_state[key]
+    if "game" in st.query_params:
+        del st.query_params["game"]
     
     # Reinitialize essential session state variables
     st.session_state.game_completed = False
+    st.session_state.game_ended_early = None
     st.session_state.current_theme = None
     st.session_state.theme_index = 0 
     st.session_state.riddles = []
@@ -352,368 +493,307 @@ def reset_session():
     st.session_state.previous_answer = ""
     st.session_state.error_message = ""
     st.session_state.show_hint = False
+    st.session_state.pipeline = None
+    st.session_state.total_riddles = NUM_RIDDLES
     st.rerun()
     
-# Initialize session state
-if "current_theme" not in st.session_state:
-    st.session_state.current_theme = None
-if 'theme_index' not in st.session_state:
-    st.session_state.theme_index = 0
-if "game_completed" not in st.session_state:
-    st.session_state.game_completed = False
-if "riddles" not in st.session_state:
-    st.session_state.riddles = []
-if "main_story" not in st.session_state:
-    st.session_state.main_story = None
-if "current_riddle_index" not in st.session_state:
-    st.session_state.current_riddle_index = 0
-if "current_image" not in st.session_state:
-    st.session_state.current_image = None
-if "start_time" not in st.session_state:
-    st.session_state.start_time = None
-if "time_limit" not in st.session_state:
-    st.session_state.time_limit = 300  # 5 minutes in seconds
-if "wrong_attempts" not in st.session_state:
-    st.session_state.wrong_attempts = 0
-if "previous_answer" not in st.session_state:
-    st.session_state.previous_answer = ""
-if "show_hint" not in st.session_state:
-    st.session_state.show_hint = False
-if "error_message" not in st.session_state:
-    st.session_state.error_message = ""
-if "audio_enabled" not in st.session_state:
-    st.session_state.audio_enabled = True
-if "current_audio" not in st.session_state:
-    st.session_state.current_audio = None
-if "audio_cache" not in st.session_state:
-    st.session_state.audio_cache = {}
+# Time (and optionally profile) this script run
+run_started = time.perf_counter()
+run_profiler = cProfile.Profile() if PROFILE_RERUNS else None
+if run_profiler:
+    run_profiler.enable()
+
+try:
+    # Initialize session state
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    if "current_theme" not in st.session_state:
+        st.session_state.current_theme = None
+    if 'theme_index' not in st.session_state:
+        st.session_state.theme_index = 0
+    if "game_completed" not in st.session_state:
+        st.session_state.game_completed = False
+    if "game_ended_early" not in st.session_state:
+        st.session_state.game_ended_early = None  # Why the adventure stopped before its last riddle
+    if "riddles" not in st.session_state:
+        st.session_state.riddles = []
+    if "main_story" not in st.session_state:
+        st.session_state.main_story = None
+    if "current_riddle_index" not in st.session_state:
+        st.session_state.current_riddle_index = 0
+    if "current_image" not in st.session_state:
+        st.session_state.current_image = None
+    if "start_time" not in st.session_state:
+        st.session_state.start_time = None
+    if "time_limit" not in st.session_state:
+        st.session_state.time_limit = SECONDS_PER_RIDDLE * NUM_RIDDLES
+    if "wrong_attempts" not in st.session_state:
+        st.session_state.wrong_attempts = 0
+    if "previous_answer" not in st.session_state:
+        st.session_state.previous_answer = ""
+    if "show_hint" not in st.session_state:
+        st.session_state.show_hint = False
+    if "error_message" not in st.session_state:
+        st.session_state.error_message = ""
+    if "audio_enabled" not in st.session_state:
+        st.session_state.audio_enabled = True
+    if "current_audio" not in st.session_state:
+        st.session_state.current_audio = None
+    if "audio_cache" not in st.session_state:
+        st.session_state.audio_cache = {}
+    if "pipeline" not in st.session_state:
+        st.session_state.pipeline = None
+    if "total_riddles" not in st.session_state:
+        st.session_state.total_riddles = NUM_RIDDLES
+    if "prefetcher" not in st.session_state:
+        st.session_state.prefetcher = NarrationPrefetcher(get_generation_executor(), PREFETCH_MAX_IN_FLIGHT)
+    if "audio_profile" not in st.session_state:
+        st.session_state.audio_profile = client_audio_profile()
+    if "locations" not in st.session_state:
+        st.session_state.locations = []
+
+    # Narration requested during this run (and by work it starts) uses the player's profile
+    call_context.audio_profile = st.session_state.audio_profile
+
+    # Keep this session's clips pinned; clips evicted while it was away are synthesized again when needed
+    missing_audio = get_blob_store().touch(st.session_state.session_id, list(st.session_state.audio_cache.values()))
+    for key in [key for key, ref in st.session_state.audio_cache.items() if ref in missing_audio]:
+        del st.session_state.audio_cache[key]
+    if st.session_state.current_audio in missing_audio:
+        st.session_state.current_audio = None
 
-# Set styles and the background if we have an image
-if st.session_state.current_image:
-    set_styles(st.session_state.current_image)
-else:
-    set_styles("")  # Default empty background
-
-# Create main game container
-main_container = st.container()
-
-with main_container:
-    # Custom title
-    st.markdown("<h1 class='game-title'>The Mind Vault</h1><div class='game-sub-title'>A place of mystery and riddles</div><br/>", unsafe_allow_html=True)
-
-    # Add an empty placeholder to hold the reset button
-    reset_placeholder = st.empty()
-
-    # Reset button (positioned outside main flow)
-    with reset_placeholder.container():
-        st.markdown("<div class='reset-button-container'>", unsafe_allow_html=True)
-        if st.button("Reset Game"):
-            reset_session()
-        st.markdown("</div>", unsafe_allow_html=True)
-
-    # Toggle for audio narration
-    col1, col2 = st.columns([3, 1])
-    with col2:
-        st.session_state.audio_enabled = st.toggle("Enable Audio Narration", value=st.session_state.audio_enabled)
-
-    # GAME COMPLETED SCREEN
-    if st.session_state.game_completed:
-        st.balloons()
-        st.success("Congratulations! You've completed all the riddles!")
+    # Resume the game named in the URL after a refresh or reconnect
+    if "game" in st.query_params and st.query_params["game"] != st.session_state.get("game_token"):
+        cancel_pipeline()
+        resume_game(st.query_params["game"])
+
+    # Pick up any generation stages and prefetched narration that finished since the last run
+    sync_pipeline()
+    for key, audio in st.session_state.prefetcher.collect().items():
+        store_session_audio(key, audio)
+    save_game()  # Also covers changes made by a previous run that ended in st.rerun()
+
+    # Warm the shared audio cache with the fixed phrases and start filling the adventure pool
+    if ELEVENLABS_API_KEY:
+        prewarm_fixed_phrases()
+    get_adventure_pool()
+
+    # Set styles and the background if we have an image
+    styles_placeholder = st.empty()
+    if st.session_state.current_image:
+        set_styles(st.session_state.current_image)
+    else:
+        set_styles("")  # Default empty background
+
+    # Create main game container
+    main_container = st.container()
+
+    with main_container:
+        # Custom title
+        st.markdown("<h1 class='game-title'>The Mind Vault</h1><div class='game-sub-title'>A place of mystery and riddles</div><br/>", unsafe_allow_html=True)
+
+        # Add an empty placeholder to hold the reset button
+        reset_placeholder = st.empty()
+
+        # Reset button (positioned outside main flow)
+        with reset_placeholder.container():
+            st.markdown("<div class='reset-button-container'>", unsafe_allow_html=True)
+            if st.button("Reset Game"):
+                reset_session()
+            st.markdown("</div>", unsafe_allow_html=True)
+
+        # Toggle for audio narration
+        col1, col2 = st.columns([3, 1])
+        with col2:
+            st.session_state.audio_enabled = st.toggle("Enable Audio Narration", value=st.session_state.audio_enabled)
+            if st.session_state.audio_enabled and get_tts_breaker().is_open():
+                st.caption("Narration is temporarily unavailable.")
+
+        # GAME COMPLETED SCREEN
+        if st.session_state.game_completed:
+            st.balloons()
+            st.success("Congratulations! You've completed all the riddles!")
         
-        # Calculate time taken
-        if st.session_state.start_time:
-            time_taken = time.time() - st.session_state.start_time
-            st.markdown(f"<div class='timer-box'><h3>Time taken: {format_time(int(time_taken))}</h3></div>", unsafe_allow_html=True)
+            # Calculate time taken
+            if st.session_state.start_time:
+                time_taken = time.time() - st.session_state.start_time
+                st.markdown(f"<div class='timer-box'><h3>Time taken: {format_time(int(time_taken))}</h3></div>", unsafe_allow_html=True)
         
-        # Generate victory audio
-        if st.session_state.audio_enabled and "victory_audio" not in st.session_state.audio_cache:
-            victory_text = "Congratulations! You've successfully completed all the riddles and escaped the mind vault. Your quick thinking and problem-solving skills have led you to victory!"
-            with st.spinner("Generating audio..."):
-                victory_audio = text_to_speech(victory_text)
-                if victory_audio:
-                    st.session_state.audio_cache["victory_audio"] = victory_audio
-                    st.session_state.current_audio = victory_audio
+            # Generate victory audio
+            if st.session_state.audio_enabled and "victory_audio" not in st.session_state.audio_cache:
+                with st.spinner("Generating audio..."):
+                    victory_audio = text_to_speech(VICTORY_TEXT)
+                    if victory_audio:
+                        store_session_audio("victory_audio", victory_audio)
         
-        # Play victory audio if available
-        if st.session_state.audio_enabled and "victory_audio" in st.session_state.audio_cache:
-            st.markdown(
-                f"<div class='audio-player'>{get_audio_player(st.session_state.audio_cache['victory_audio'])}</div>",
-                unsafe_allow_html=True
-            )
+            # Play victory audio if available
+            if st.session_state.audio_enabled and "victory_audio" in st.session_state.audio_cache:
+                st.markdown(
+                    f"<div class='audio-player'>{get_audio_player(st.session_state.audio_cache['victory_audio'])}</div>",
+                    unsafe_allow_html=True
+                )
         
-        # Center the start new game button
-        st.markdown("<div class='centered-button'>", unsafe_allow_html=True)
-        if st.button("Start New Game"):    
-            reset_session()
-        st.markdown("</div>", unsafe_allow_html=True)
+            # Center the start new game button
+            st.markdown("<div class='centered-button'>", unsafe_allow_html=True)
+            if st.button("Start New Game"):    
+                reset_session()
+            st.markdown("</div>", unsafe_allow_html=True)
 
-    # ACTIVE GAME SCREEN
-    else:
-        # Choose a theme with an empty initial selection
-        theme_choice = st.selectbox("Select a theme", [""] + ["Mystery Mansion", "Ancient Ruins", "Space Odyssey", "Enchanted Forest"], index=st.session_state.theme_index)
+        # ADVENTURE ENDED EARLY SCREEN: the next riddle could not be generated
+        elif st.session_state.game_ended_early:
+            st.error(st.session_state.game_ended_early)
+            st.warning(f"This adventure ended early after {st.session_state.current_riddle_index} riddles. Start a new game to play again.")
+            st.markdown("<div class='centered-button'>", unsafe_allow_html=True)
+            if st.button("Start New Game"):
+                reset_session()
+            st.markdown("</div>", unsafe_allow_html=True)
+
+        # ACTIVE GAME SCREEN
+        else:
+            # Choose a theme with an empty initial selection
+            theme_choice = st.selectbox("Select a theme", [""] + THEMES, index=st.session_state.theme_index)
        
-        if theme_choice and (theme_choice != st.session_state.current_theme or not st.session_state.riddles):
-            st.session_state.current_theme = theme_choice
-            st.session_state.start_time = time.time()  # Reset timer when theme changes
-            st.session_state.wrong_attempts = 0  # Reset wrong attempts
-            st.session_state.current_riddle_index = 0  # Reset to first riddle
-            st.session_state.error_message = ""
-            st.session_state.show_hint = False
-            st.session_state.audio_cache = {}  # Clear audio cache when theme changes
-
-            # Generate storyline and riddles
-            with st.spinner("Creating your adventure..."):
-                try:
-                    main_story, riddles = generate_escape_room_adventure(theme_choice)
-                    st.session_state.main_story = main_story
-                    st.session_state.riddles = riddles
-                except Exception as e:
-                    st.error(f"Error generating adventure: {str(e)}")
-                    st.session_state.main_story = "An error occurred while creating your adventure."
-                    st.session_state.riddles = []
+            if theme_choice and (theme_choice != st.session_state.current_theme or not st.session_state.riddles):
+                st.session_state.current_theme = theme_choice
+                st.session_state.start_time = time.time()  # Reset timer when theme changes
+                st.session_state.wrong_attempts = 0  # Reset wrong attempts
+                st.session_state.current_riddle_index = 0  # Reset to first riddle
+                st.session_state.error_message = ""
+                st.session_state.show_hint = False
+                clear_session_audio()  # Clear audio cache when theme changes
+                start_saved_game()
 
-            # Generate image
-            with st.spinner("Creating themed background..."):
-                try:
-                    image_url = generate_image(theme_choice)
-                    st.session_state.current_image = image_url
-                    # Set styles again with the new image
-                    set_styles(image_url)
-                except Exception as e:
-                    st.error(f"Error generating image: {str(e)}")
+                # Take a pre-generated adventure from the pool if one is ready
+                cancel_pipeline()
+                st.session_state.prefetcher.cancel()
+                pooled_adventure = get_adventure_pool().take(theme_choice)
+                if pooled_adventure:
+                    st.session_state.main_story = pooled_adventure["main_story"]
+                    st.session_state.riddles = pooled_adventure["riddles"]
+                    st.session_state.locations = [riddle["location"] for riddle in pooled_adventure["riddles"]]
+                    st.session_state.total_riddles = len(pooled_adventure["riddles"])
+                    st.session_state.current_image = pooled_adventure["image"]
+                    if pooled_adventure["image"]:
+                        set_styles(pooled_adventure["image"])
+                    if pooled_adventure["intro_audio"]:
+                        if st.session_state.audio_enabled:
+                            get_blob_store().acquire(st.session_state.session_id, pooled_adventure["intro_audio"])
+                            st.session_state.audio_cache["intro"] = pooled_adventure["intro_audio"]
+                            st.session_state.current_audio = pooled_adventure["intro_audio"]
+                        get_blob_store().release(ADVENTURE_POOL_HOLDER, pooled_adventure["intro_audio"])
+                else:
+                    # Start every stage at once; the page appears as soon as the story and first riddle exist,
+                    # and the background and narration are filled in when they finish
+                    st.session_state.pipeline = start_adventure_pipeline(theme_choice, narrate=session_narration(NUM_RIDDLES),
+                                                                         ahead=RIDDLES_AHEAD)
+                    st.session_state.riddles = []
+                    st.session_state.total_riddles = NUM_RIDDLES
                     st.session_state.current_image = None
+                    with st.spinner("Creating your adventure..."):
+                        try:
+                            st.session_state.main_story, st.session_state.locations = st.session_state.pipeline.result("storyline")
+                            sync_pipeline(wait_for="riddle_0")
+                        except Exception as e:
+                            st.error(f"Error generating adventure: {str(e)}")
+                            st.session_state.main_story = "An error occurred while creating your adventure."
+                            st.session_state.riddles = []
+                            cancel_pipeline()
+                    if st.session_state.current_image:
+                        set_styles(st.session_state.current_image)
 
-            # Generate intro audio if enabled
-            if st.session_state.audio_enabled and st.session_state.main_story:
-                with st.spinner("Generating narration..."):
-                    intro_audio = text_to_speech(st.session_state.main_story)
-                    if intro_audio:
-                        st.session_state.audio_cache["intro"] = intro_audio
-                        st.session_state.current_audio = intro_audio
-
-        # Display timer if we have a theme
-        if st.session_state.current_theme and st.session_state.start_time:
-            # Calculate time remaining
-            elapsed = time.time() - st.session_state.start_time
-            remaining = max(0, st.session_state.time_limit - int(elapsed))
+            # Display timer if we have a theme
+            if st.session_state.current_theme and st.session_state.start_time:
+                # Calculate time remaining
+                elapsed = time.time() - st.session_state.start_time
+                remaining = max(0, st.session_state.time_limit - int(elapsed))
             
-            # Display themed timer
-            timer_class = get_timer_class(st.session_state.current_theme)
-            st.markdown(f"<div class='timer-box {timer_class}'>Time Remaining: {format_time(remaining)}</div>", unsafe_allow_html=True)
+                # Display themed timer
+                timer_class = get_timer_class(st.session_state.current_theme)
+                render_countdown(remaining, timer_class)
             
-            # Display progress bar
-            progress_percentage = (st.session_state.current_riddle_index / 4) * 100
-            st.markdown(
-                f"""
-                <div class='progress-bar'>
-                    <div class='progress-fill' style='width: {progress_percentage}%;'>
-                        {st.session_state.current_riddle_index}/4 Riddles
-                    </div>
-                </div>
-                """, 
-                unsafe_allow_html=True
-            )
-
-            # Check if time's up
-            if remaining <= 0:
-                st.error("Time's up! You couldn't solve the riddles in time.")
+                # Check if time's up
+                if remaining <= 0:
+                    render_progress()
+                    st.error("Time's up! You couldn't solve the riddles in time.")
                 
-                # Generate time's up audio
-                if st.session_state.audio_enabled and "times_up" not in st.session_state.audio_cache:
-                    times_up_text = "Time's up! You couldn't solve all the riddles in time. Don't worry, you can try again and see if you can beat the clock."
-                    times_up_audio = text_to_speech(times_up_text)
-                    if times_up_audio:
-                        st.session_state.audio_cache["times_up"] = times_up_audio
-                        st.session_state.current_audio = times_up_audio
+                    # Generate time's up audio
+                    if st.session_state.audio_enabled and "times_up" not in st.session_state.audio_cache:
+                        times_up_audio = text_to_speech(TIMES_UP_TEXT)
+                        if times_up_audio:
+                            store_session_audio("times_up", times_up_audio)
                 
-                # Play time's up audio
-                if st.session_state.audio_enabled and "times_up" in st.session_state.audio_cache:
-                    st.markdown(
-                        f"<div class='audio-player'>{get_audio_player(st.session_state.audio_cache['times_up'])}</div>",
-                        unsafe_allow_html=True
-                    )
+                    # Play time's up audio
+                    if st.session_state.audio_enabled and "times_up" in st.session_state.audio_cache:
+                        st.markdown(
+                            f"<div class='audio-player'>{get_audio_player(st.session_state.audio_cache['times_up'])}</div>",
+                            unsafe_allow_html=True
+                        )
                 
-                st.markdown("<div class='centered-button'>", unsafe_allow_html=True)
-                if st.button("Try Again"):
-                    st.session_state.start_time = time.time()  # Reset timer
-                    st.session_state.wrong_attempts = 0  # Reset wrong attempts
-                    st.session_state.error_message = ""
-                    st.session_state.show_hint = False
-                    st.rerun()
-                st.markdown("</div>", unsafe_allow_html=True)
+                    st.markdown("<div class='centered-button'>", unsafe_allow_html=True)
+                    if st.button("Try Again"):
+                        st.session_state.start_time = time.time()  # Reset timer
+                        st.session_state.wrong_attempts = 0  # Reset wrong attempts
+                        st.session_state.error_message = ""
+                        st.session_state.show_hint = False
+                        st.rerun()
+                    st.markdown("</div>", unsafe_allow_html=True)
         
-            # Display main story only on the first riddle
-            elif st.session_state.current_riddle_index == 0 and st.session_state.main_story:
-                st.markdown(f"<div class='story-box'><h3>Your Adventure Begins:</h3>{st.session_state.main_story}</div>", unsafe_allow_html=True)
-                
-                # Display audio player for main story
-                if st.session_state.audio_enabled and "intro" in st.session_state.audio_cache:
-                    st.markdown(
-                        f"<div class='audio-player'>{get_audio_player(st.session_state.audio_cache['intro'])}</div>",
-                        unsafe_allow_html=True
-                    )
-                
-            # Display the current riddle if riddles exist and time remains
-            if st.session_state.riddles and st.session_state.current_riddle_index < len(st.session_state.riddles):
-                current_riddle = st.session_state.riddles[st.session_state.current_riddle_index]
-                
-                # Generate audio for current riddle if not already in cache
-                riddle_audio_key = f"riddle_{st.session_state.current_riddle_index}"
-                if st.session_state.audio_enabled and riddle_audio_key not in st.session_state.audio_cache:
-                    riddle_text = f"Location: {current_riddle['location']}. Riddle: {current_riddle['riddle']}"
-                    with st.spinner("Generating riddle narration..."):
-                        riddle_audio = text_to_speech(riddle_text)
-                        if riddle_audio:
-                            st.session_state.audio_cache[riddle_audio_key] = riddle_audio
-                            st.session_state.current_audio = riddle_audio
-                
-                # Display location story and riddle together
+                # The riddle, hint and answer input rerun on their own when an answer is submitted
+                else:
+                    riddle_area()
+            elif not theme_choice:
+                # No theme selected yet
                 st.markdown(
                     f"""
-                    <div class='riddle-box'>
-                        <p class='location-story'>{current_riddle['location']}</p>
-                        <h4>Riddle {st.session_state.current_riddle_index + 1} of 4:</h4>
-                        <p class='riddle-text'>{current_riddle['riddle']}</p>
+                    <div class="game-container">
+                        <h2>Welcome to The Mind Vault</h2>
+                        <p>Select a theme above to begin your escape room adventure!</p>
+                        <ul>
+                            <li><strong>Mystery Mansion</strong>: Solve riddles in a haunted Victorian mansion</li>
+                            <li><strong>Ancient Ruins</strong>: Uncover secrets in forgotten temple ruins</li>
+                            <li><strong>Space Odyssey</strong>: Navigate puzzles on an abandoned space station</li>
+                            <li><strong>Enchanted Forest</strong>: Decode magical riddles in a mystical woodland</li>
+                        </ul>
+                        <p>You'll have {format_time(SECONDS_PER_RIDDLE * NUM_RIDDLES)} to solve all {NUM_RIDDLES} riddles and escape!</p>
                     </div>
-                    """, 
+                    """,
                     unsafe_allow_html=True
                 )
-                
-                # Play riddle audio
-                if st.session_state.audio_enabled and riddle_audio_key in st.session_state.audio_cache:
-                    st.markdown(
-                        f"<div class='audio-player'>{get_audio_player(st.session_state.audio_cache[riddle_audio_key])}</div>",
-                        unsafe_allow_html=True
-                    )
-                
-                # Create error message container
-                error_placeholder = st.empty()
-
-                # Display hint if 3 or more wrong attempts
-                if st.session_state.wrong_attempts >= 3:
-                    st.markdown(f"<div class='hint-box'><h3>Hint:</h3>{current_riddle['hint']}</div>", unsafe_allow_html=True)
-                    
-                    # Generate hint audio if not already cached
-                    hint_audio_key = f"hint_{st.session_state.current_riddle_index}"
-                    if st.session_state.audio_enabled and hint_audio_key not in st.session_state.audio_cache:
-                        hint_text = f"Here's a hint: {current_riddle['hint']}"
-                        with st.spinner("Generating hint narration..."):
-                            hint_audio = text_to_speech(hint_text)
-                            if hint_audio:
-                                st.session_state.audio_cache[hint_audio_key] = hint_audio
-                                st.session_state.current_audio = hint_audio
-                    
-                    # Play hint audio
-                    if st.session_state.audio_enabled and hint_audio_key in st.session_state.audio_cache:
-                        st.markdown(
-                            f"<div class='audio-player'>{get_audio_player(st.session_state.audio_cache[hint_audio_key])}</div>",
-                            unsafe_allow_html=True
-                        )
-                
-                # Use placeholder text in input box instead of label
-                user_answer = st.text_input("User Answer", placeholder="Enter your answer here and press Enter...", key=f"answer_input_{st.session_state.current_riddle_index}", label_visibility="collapsed")
-
-                # Display any existing error message
-                if st.session_state.error_message:
-                    error_placeholder.markdown(f"""
-                    <div class="error-message">
-                    {st.session_state.error_message}
-                    </div>
-                    """, unsafe_allow_html=True)
-                   
-                # Check if Enter was pressed (when the input value changes)
-                if user_answer and user_answer != st.session_state.previous_answer:
-                    # Store current answer to detect changes
-                    st.session_state.previous_answer = user_answer
-                    
-                    # Check if answer is correct (case insensitive and multiple potential answers)
-                    user_answer_lower = user_answer.strip().lower()
-                    correct_answers = [ans.strip().lower() for ans in current_riddle['answer'].split(',')]
-                    
-                    if any(user_answer_lower == ans or user_answer_lower in ans for ans in correct_answers):
-                        # Generate correct answer audio
-                        if st.session_state.audio_enabled and "correct_answer" not in st.session_state.audio_cache:
-                            correct_text = "Correct! Moving to the next challenge."
-                            with st.spinner("Generating audio..."):
-                                correct_audio = text_to_speech(correct_text)
-                                if correct_audio:
-                                    st.session_state.audio_cache["correct_answer"] = correct_audio
-                                    st.session_state.current_audio = correct_audio
-                        
-                        # Move to the next riddle
-                        st.session_state.current_riddle_index += 1
-                        st.session_state.wrong_attempts = 0  # Reset wrong attempts for next riddle
-                        st.session_state.previous_answer = ""  # Reset previous answer
-                        st.session_state.error_message = ""   # Clear error message
-                        st.session_state.show_hint = False    # Hide hint for next riddle
-                            
-                        # Check if all riddles are completed
-                        if st.session_state.current_riddle_index >= len(st.session_state.riddles):
-                            st.session_state.game_completed = True
-                        
-                        # Rerun to update the page with new riddle or completion screen
-                        st.rerun()
-                    else:
-                        # Wrong answer
-                        st.session_state.wrong_attempts += 1
-                        
-                        # Generate wrong answer audio if not already cached
-                        wrong_audio_key = f"wrong_{min(st.session_state.wrong_attempts, 3)}"
-                        if st.session_state.audio_enabled and wrong_audio_key not in st.session_state.audio_cache:
-                            wrong_messages = [
-                                "That's not correct. Try again!",
-                                "Not quite right. Give it another try.",
-                                "Still not correct. Think carefully about the riddle. A hint will appear soon."
-                            ]
-                            wrong_text = wrong_messages[min(st.session_state.wrong_attempts, 3) - 1]
-                            with st.spinner("Generating audio..."):
-                                wrong_audio = text_to_speech(wrong_text)
-                                if wrong_audio:
-                                    st.session_state.audio_cache[wrong_audio_key] = wrong_audio
-                                    st.session_state.current_audio = wrong_audio
-                        
-                        # Set error message
-                        if st.session_state.wrong_attempts >= 3:
-                            st.session_state.error_message = "That's not correct. A hint has been provided above."
-                            st.session_state.show_hint = True
-                        else:
-                            st.session_state.error_message = f"That's not correct. Try again! ({st.session_state.wrong_attempts}/3 attempts)"
-                        
-                        # Play wrong answer audio
-                        if st.session_state.audio_enabled and wrong_audio_key in st.session_state.audio_cache:
-                            st.markdown(
-                                f"<div class='audio-player'>{get_audio_player(st.session_state.audio_cache[wrong_audio_key])}</div>",
-                                unsafe_allow_html=True
-                            )
-                        
-                        # Force a rerun to show the updated error message
-                        st.rerun()
-        elif not theme_choice:
-            # No theme selected yet
-            st.markdown(
-                """
-                <div class="game-container">
-                    <h2>Welcome to The Mind Vault</h2>
-                    <p>Select a theme above to begin your escape room adventure!</p>
-                    <ul>
-                        <li><strong>Mystery Mansion</strong>: Solve riddles in a haunted Victorian mansion</li>
-                        <li><strong>Ancient Ruins</strong>: Uncover secrets in forgotten temple ruins</li>
-                        <li><strong>Space Odyssey</strong>: Navigate puzzles on an abandoned space station</li>
-                        <li><strong>Enchanted Forest</strong>: Decode magical riddles in a mystical woodland</li>
-                    </ul>
-                    <p>You'll have 5 minutes to solve all four riddles and escape!</p>
-                </div>
-                """,
-                unsafe_allow_html=True
-            )
             
-            # Store theme index for future use
-            if theme_choice:
-                themes = ["Mystery Mansion", "Ancient Ruins", "Space Odyssey", "Enchanted Forest"]
-                if theme_choice in themes:
-                    st.session_state.theme_index = themes.index(theme_choice) + 1  # +1 because index 0 is empty
+                # Store theme index for future use
+                if theme_choice:
+                    if theme_choice in THEMES:
+                        st.session_state.theme_index = THEMES.index(theme_choice) + 1  # +1 because index 0 is empty
             
-            # Reset timer and progress when no theme is selected
-            st.session_state.start_time = None
-            st.session_state.current_riddle_index = 0
\ No newline at end of file
+                # Reset timer and progress when no theme is selected
+                st.session_state.start_time = None
+                st.session_state.current_riddle_index = 0
+
+    # Audio memory accounting for operators: bytes referenced by this session, by every session, and stored once
+    if MEMORY_STATS_VIEW:
+        with st.expander("Memory usage"):
+            blob_stats = get_blob_store().stats()
+            st.write(f"This session: {blob_stats['holders'].get(st.session_state.session_id, 0) / 1024:.1f} KB of audio")
+            st.write(f"All holders: {blob_stats['referenced_bytes'] / 1024:.1f} KB referenced, "
+                     f"{blob_stats['total_bytes'] / 1024:.1f} KB stored in {blob_stats['blobs']} clips")
+            st.json(blob_stats["holders"])
+
+    save_game()
+finally:
+    # Record how long this run took, including runs cut short by st.rerun() or st.stop()
+    get_metrics().observe("mindvault_script_run_seconds", {}, time.perf_counter() - run_started)
+    if run_profiler:
+        run_profiler.disable()
+        profile_output = io.StringIO()
+        pstats.Stats(run_profiler, stream=profile_output).sort_stats("cumulative").print_stats(15)
+        metrics_logger.info("Script run profile:\n%s", profile_output.getvalue())
+
+# Finish the background and narration stages the page is still waiting on, then show them
+if st.session_state.pipeline and awaited_stages(st.session_state.pipeline):
+    with st.spinner("Adding background and narration..."):
+        for name in awaited_stages(st.session_state.pipeline):
+            try:
+                st.session_state.pipeline.result(name)
+            except Exception:
+                pass  # Reported by sync_pipeline on the next run
+    st.rerun()
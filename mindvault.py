@@ -0,0 +1,2021 @@
+import openai
+from openai import OpenAI
+import os
+import time
+import requests
+import re
+import difflib
+import hashlib
+import json
+import logging
+import threading
+import random
+import io
+import shutil
+import uuid
+import sys
+import queue
+import subprocess
+import sqlite3
+import heapq
+import itertools
+import functools
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from requests.adapters import HTTPAdapter
+from PIL import Image
+
+# Adventure generation, narration and storage shared by the Streamlit app (escaperoom.py) and the
+# standalone generation service (python mindvault.py serve). Nothing here depends on Streamlit.
+
+# One instance per process: the first call builds it and every later call, from any thread, gets the same one
+def shared(func):
+    lock = threading.Lock()
+    instance = []
+    @functools.wraps(func)
+    def get():
+        with lock:
+            if not instance:
+                instance.append(func())
+            return instance[0]
+    return get
+
+# Provider timeouts and retry policy
+OPENAI_CONNECT_TIMEOUT = 5.0
+OPENAI_READ_TIMEOUT = float(os.getenv("OPENAI_READ_TIMEOUT", "60"))
+OPENAI_MAX_RETRIES = 3  # The SDK retries 429/5xx with jittered exponential backoff
+TTS_CONNECT_TIMEOUT = 5.0
+TTS_READ_TIMEOUT = float(os.getenv("TTS_READ_TIMEOUT", "30"))
+HTTP_MAX_RETRIES = 3
+HTTP_BACKOFF_BASE = 0.5  # Seconds; doubled on every attempt
+HTTP_BACKOFF_MAX = 8.0
+HTTP_POOL_SIZE = 32
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# OpenAI client; every call reuses its keep-alive connection pool
+@shared
+def get_openai_client():
+    return OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        timeout=openai.Timeout(OPENAI_READ_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+        max_retries=OPENAI_MAX_RETRIES
+    )
+
+ELEVENLABS_API_KEY = os.getenv("ELEVENLABS_API_KEY")
+ELEVENLABS_API_URL = os.getenv("ELEVENLABS_API_URL", "https://api.elevenlabs.io/v1")
+ELEVENLABS_VOICE_ID = "N2lVS1w4EtoT3dr4eOWO"
+ELEVENLABS_MODEL_ID = "eleven_monolingual_v1"
+ELEVENLABS_VOICE_SETTINGS = {
+    "stability": 0.5,
+    "similarity_boost": 0.8
+}
+THEMES = ["Mystery Mansion", "Ancient Ruins", "Space Odyssey", "Enchanted Forest"]
+
+logger = logging.getLogger("mindvault")
+
+# Local storage for caches shared by every session
+DATA_DIR = os.getenv("MINDVAULT_DATA_DIR", ".mindvault")
+AUDIO_CACHE_DIR = os.path.join(DATA_DIR, "audio")
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+# Files under static/ are served by Streamlit at app/static/ (see .streamlit/config.toml). Generated audio and
+# images are written to STATIC_DIR; a folder set with MINDVAULT_STATIC_DIR must itself be served at app/static/.
+APP_STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+STATIC_DIR = os.getenv("MINDVAULT_STATIC_DIR", APP_STATIC_DIR)
+STATIC_AUDIO_DIR = os.path.join(STATIC_DIR, "audio")
+STATIC_AUDIO_URL = "app/static/audio"
+STATIC_AUDIO_MAX_BYTES = int(os.getenv("STATIC_AUDIO_MAX_BYTES", str(100 * 1024 * 1024)))
+BLOB_SESSION_TTL = int(os.getenv("BLOB_SESSION_TTL", "3600"))  # Release a session's audio after this long without a rerun
+MEMORY_STATS_VIEW = os.getenv("MEMORY_STATS_VIEW", "0") == "1"
+
+# Resumable games, saved under the token in the page URL (?game=...)
+GAME_STORE_PATH = os.path.join(DATA_DIR, "games.sqlite3")
+GAME_STORE_TTL = int(os.getenv("GAME_STORE_TTL", str(24 * 3600)))  # Forget games not touched for this long
+GAME_STATE_KEYS = ["current_theme", "main_story", "locations", "riddles", "total_riddles", "current_riddle_index",
+                   "current_image", "start_time", "time_limit", "wrong_attempts", "show_hint", "game_completed", "game_ended_early", "audio_cache"]
+
+# Background images are downloaded once, re-encoded and served from static/images/<theme>/<hash>/
+STATIC_IMAGE_DIR = os.path.join(STATIC_DIR, "images")
+STATIC_IMAGE_URL = "app/static/images"
+IMAGE_WIDTHS = [512, 1024]  # Small screens get the first width, everything else the last
+IMAGE_FORMATS = {"webp": {"format": "WEBP", "quality": 75, "method": 4},
+                 "jpg": {"format": "JPEG", "quality": 80, "optimize": True, "progressive": True}}
+IMAGES_PER_THEME = int(os.getenv("IMAGES_PER_THEME", "3"))  # Reuse cached images once a theme has this many
+
+# Streaming narration: the story and riddles play from a local endpoint while ElevenLabs is still synthesizing
+TTS_STREAMING = os.getenv("TTS_STREAMING", "0") == "1"
+TTS_STREAM_HOST = os.getenv("TTS_STREAM_HOST", "127.0.0.1")
+TTS_STREAM_PORT = int(os.getenv("TTS_STREAM_PORT", "8502"))
+TTS_STREAM_PUBLIC_URL = os.getenv("TTS_STREAM_PUBLIC_URL", f"http://localhost:{TTS_STREAM_PORT}")
+TTS_STREAM_CHUNK_SIZE = 4096
+TTS_STREAM_PENDING_TTL = 600  # Seconds a registered narration URL stays playable before the browser asks for it
+TTS_STREAM_MAX_PENDING = 1000  # Registered narrations kept at most; the oldest are dropped first
+
+# Narration output profiles, requested from ElevenLabs through its output_format parameter.
+# MP3 output is mono; "voice" is sized for speech on phones, "original" is the API default (128 kbps).
+AUDIO_PROFILES = {
+    "voice": {"output_format": "mp3_22050_32", "extension": ".mp3", "mime_type": "audio/mpeg"},
+    "standard": {"output_format": "mp3_44100_64", "extension": ".mp3", "mime_type": "audio/mpeg"},
+    "opus": {"output_format": "opus_48000_32", "extension": ".ogg", "mime_type": "audio/ogg"},
+    "original": {"output_format": None, "extension": ".mp3", "mime_type": "audio/mpeg"}
+}
+AUDIO_PROFILE_MOBILE = os.getenv("AUDIO_PROFILE_MOBILE", "voice")
+AUDIO_PROFILE_DESKTOP = os.getenv("AUDIO_PROFILE_DESKTOP", "standard")
+AUDIO_MIME_TYPES = {".mp3": "audio/mpeg", ".ogg": "audio/ogg", ".wav": "audio/wav"}
+
+# Hedged narration: past the latency budget a clip is spoken by a local engine while ElevenLabs finishes for the cache
+TTS_LATENCY_BUDGET = float(os.getenv("TTS_LATENCY_BUDGET", "0"))  # Seconds; 0 always waits for ElevenLabs
+TTS_FALLBACK_ENGINE = os.getenv("TTS_FALLBACK_ENGINE", "auto")  # auto, espeak-ng, espeak or pyttsx3
+TTS_FALLBACK_TIMEOUT = 10.0
+TTS_HEDGE_WORKERS = int(os.getenv("TTS_HEDGE_WORKERS", "8"))  # ElevenLabs calls in flight for hedged narration
+
+# Fixed narration phrases, synthesized once and reused by every game
+CORRECT_TEXT = "Correct! Moving to the next challenge."
+WRONG_MESSAGES = [
+    "That's not correct. Try again!",
+    "Not quite right. Give it another try.",
+    "Still not correct. Think carefully about the riddle. A hint will appear soon."
+]
+TIMES_UP_TEXT = "Time's up! You couldn't solve all the riddles in time. Don't worry, you can try again and see if you can beat the clock."
+VICTORY_TEXT = "Congratulations! You've successfully completed all the riddles and escaped the mind vault. Your quick thinking and problem-solving skills have led you to victory!"
+LOCATION_LEAD_IN = "Location:"
+RIDDLE_LEAD_IN = "Riddle:"
+HINT_LEAD_IN = "Here's a hint:"
+FIXED_PHRASES = [CORRECT_TEXT] + WRONG_MESSAGES + [TIMES_UP_TEXT, VICTORY_TEXT, LOCATION_LEAD_IN, RIDDLE_LEAD_IN, HINT_LEAD_IN]
+NARRATION_STITCHING = os.getenv("NARRATION_STITCHING", "1") == "1"  # Synthesize only the variable parts of riddle and hint narration
+
+# Instrumentation: Prometheus-style metrics on METRICS_PORT, optional JSON log lines, optional script profiling
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 disables the /metrics endpoint
+METRICS_LOG = os.getenv("METRICS_LOG", "0") == "1"
+PROFILE_RERUNS = os.getenv("PROFILE_RERUNS", "0") == "1"
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+metrics_logger = logging.getLogger("mindvault.metrics")
+# Streamlit leaves the root logger without handlers at WARNING, so the metrics log writes to stderr on its own
+if (METRICS_LOG or PROFILE_RERUNS) and not metrics_logger.handlers:
+    metrics_logger.addHandler(logging.StreamHandler())
+    metrics_logger.setLevel(logging.INFO)
+    metrics_logger.propagate = False
+
+# Thread-safe counters and histograms rendered in the Prometheus text format
+class Metrics:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}  # (name, labels) -> current value
+        self.histograms = {}  # (name, labels) -> [count per bucket..., sum, count]
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def render(self):
+        def label_text(labels, extra=()):
+            pairs = [f'{k}="{v}"' for k, v in list(labels) + list(extra)]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(list(self.counters.items()) + list(self.gauges.items())):
+                lines.append(f"{name}{label_text(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                for bound, count in zip(self.buckets, histogram):
+                    lines.append(f"{name}_bucket{label_text(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{label_text(labels, [('le', '+Inf')])} {histogram[-1]}")
+                lines.append(f"{name}_sum{label_text(labels)} {histogram[-2]}")
+                lines.append(f"{name}_count{label_text(labels)} {histogram[-1]}")
+        return "\n".join(lines) + "\n"
+
+# Minimal HTTP endpoint exposing the metrics at /metrics
+def start_metrics_server(metrics, port):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    httpd = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="metrics", daemon=True).start()
+
+@shared
+def get_metrics():
+    metrics = Metrics(LATENCY_BUCKETS)
+    if METRICS_PORT:
+        start_metrics_server(metrics, METRICS_PORT)
+    return metrics
+
+# Record one provider call (or cache lookup standing in for one)
+def record_provider_call(stage, seconds, cache="none", outcome="ok", prompt_tokens=0, completion_tokens=0, response_bytes=0, retries=0):
+    metrics = get_metrics()
+    labels = {"stage": stage, "cache": cache, "outcome": outcome}
+    metrics.inc("mindvault_provider_calls_total", labels)
+    metrics.observe("mindvault_provider_call_seconds", {"stage": stage, "cache": cache}, seconds)
+    metrics.inc("mindvault_prompt_tokens_total", {"stage": stage}, prompt_tokens)
+    metrics.inc("mindvault_completion_tokens_total", {"stage": stage}, completion_tokens)
+    metrics.inc("mindvault_response_bytes_total", {"stage": stage}, response_bytes)
+    metrics.inc("mindvault_retries_total", {"stage": stage}, retries)
+    if METRICS_LOG:
+        metrics_logger.info(json.dumps({
+            "event": "provider_call", "stage": stage, "cache": cache, "outcome": outcome, "seconds": round(seconds, 4),
+            "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "response_bytes": response_bytes, "retries": retries
+        }))
+
+# Provider rate limits, per minute (0 disables the limit)
+OPENAI_REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "500"))
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "200000"))
+ELEVENLABS_CHARACTERS_PER_MINUTE = int(os.getenv("ELEVENLABS_CHARACTERS_PER_MINUTE", "30000"))
+PRIORITY_CLASSES = ["interactive", "generation", "background"]  # Served in this order when quota is short
+
+# Per-thread context for provider calls: the priority class (script threads are interactive)
+# and the narration profile of the player the work is for
+call_context = threading.local()
+
+def current_priority():
+    return getattr(call_context, "priority", None) or "interactive"
+
+def current_audio_profile():
+    return getattr(call_context, "audio_profile", None) or AUDIO_PROFILE_DESKTOP
+
+# The context to hand to work started on another thread
+def capture_call_context(**overrides):
+    return dict({"priority": current_priority(), "audio_profile": current_audio_profile()}, **overrides)
+
+# Run func with the given call context, restoring the thread's own afterwards
+def run_in_context(context, func, *args):
+    previous = {name: getattr(call_context, name, None) for name in context}
+    for name, value in context.items():
+        setattr(call_context, name, value)
+    try:
+        return func(*args)
+    finally:
+        for name, value in previous.items():
+            setattr(call_context, name, value)
+
+# Token bucket refilled continuously at its per-minute limit, holding at most one minute of quota
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until amount is available
+    def wait_time(self, amount):
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+    def give_back(self, amount):
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+# Rate limiter for one provider: callers queue by priority class, then arrival, and the head of the
+# queue goes as soon as every bucket it draws from has enough quota
+class QuotaScheduler:
+    def __init__(self, provider, limits):
+        self.provider = provider
+        self.buckets = {name: TokenBucket(limit) for name, limit in limits.items() if limit > 0}
+        self.condition = threading.Condition()
+        self.waiting = []  # heap of (priority rank, arrival number)
+        self.arrivals = itertools.count()
+
+    # Block until the quota is available, returning the seconds spent waiting. priority is a priority class,
+    # or a function returning the caller's current one when it can rise while waiting (see wake)
+    def acquire(self, costs, priority):
+        costs = {name: amount for name, amount in costs.items() if name in self.buckets and amount > 0}
+        if not costs:
+            return 0.0
+        current = priority if callable(priority) else lambda: priority
+        start = time.monotonic()
+        ticket = (PRIORITY_CLASSES.index(current()), next(self.arrivals))
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+            self._publish_depth()
+            while True:
+                rank = PRIORITY_CLASSES.index(current())
+                if rank < ticket[0]:
+                    self.waiting.remove(ticket)
+                    heapq.heapify(self.waiting)
+                    ticket = (rank, ticket[1])
+                    heapq.heappush(self.waiting, ticket)
+                    self._publish_depth()
+                if self.waiting[0] == ticket:
+                    delay = max(self.buckets[name].wait_time(amount) for name, amount in costs.items())
+                    if delay == 0:
+                        break
+                    self.condition.wait(delay)
+                else:
+                    self.condition.wait()
+            for name, amount in costs.items():
+                self.buckets[name].take(amount)
+            heapq.heappop(self.waiting)
+            self._publish_depth()
+            self.condition.notify_all()
+        waited = time.monotonic() - start
+        get_metrics().observe("mindvault_quota_wait_seconds", {"provider": self.provider, "priority": PRIORITY_CLASSES[ticket[0]]}, waited)
+        return waited
+
+    # Let waiting callers re-read their priority
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    # Return quota that was reserved but not used (e.g. an overestimated token count)
+    def release(self, costs):
+        with self.condition:
+            for name, amount in costs.items():
+                if name in self.buckets and amount > 0:
+                    self.buckets[name].give_back(amount)
+            self.condition.notify_all()
+
+    # Callers waiting per priority class
+    def queue_depth(self):
+        with self.condition:
+            return {priority: sum(1 for rank, _ in self.waiting if rank == i) for i, priority in enumerate(PRIORITY_CLASSES)}
+
+    def _publish_depth(self):
+        metrics = get_metrics()
+        for i, priority in enumerate(PRIORITY_CLASSES):
+            depth = sum(1 for rank, _ in self.waiting if rank == i)
+            metrics.set("mindvault_quota_queue_depth", {"provider": self.provider, "priority": priority}, depth)
+
+# One scheduler per provider
+@shared
+def get_quota_schedulers():
+    return {
+        "openai": QuotaScheduler("openai", {"requests": OPENAI_REQUESTS_PER_MINUTE, "tokens": OPENAI_TOKENS_PER_MINUTE}),
+        "elevenlabs": QuotaScheduler("elevenlabs", {"characters": ELEVENLABS_CHARACTERS_PER_MINUTE})
+    }
+
+# Upper bound on the tokens a chat request can use: its prompt (about four characters a token) plus max_tokens
+def openai_token_estimate(kwargs):
+    prompt_characters = sum(len(message.get("content") or "") for message in kwargs.get("messages", []))
+    return prompt_characters // 4 + kwargs.get("max_tokens", 0)
+
+# Single-flight coalescing: concurrent calls with the same key share one in-flight call and its result.
+# A call serves every caller waiting on it, so it carries the highest priority class among them.
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # key -> Future of the call in flight
+        self.priorities = {}  # key -> highest priority class among the callers of the call in flight
+
+    # Run func unless an identical call is already in flight; returns (result, shared).
+    # A caller joining with a higher priority raises the call's priority, then on_join is called.
+    def do(self, key, func, priority=None, on_join=None):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+                self.priorities[key] = priority
+            elif priority and PRIORITY_CLASSES.index(priority) < PRIORITY_CLASSES.index(self.priorities[key] or priority):
+                self.priorities[key] = priority
+            else:
+                on_join = None
+        if not leader:
+            if on_join:
+                on_join()
+            return future.result(), True
+        try:
+            result = func()
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+                self.priorities.pop(key, None)
+
+    # Priority of the call in flight for key, or the calling thread's own when there is none
+    def priority(self, key):
+        with self.lock:
+            return self.priorities.get(key) or current_priority()
+
+@shared
+def get_single_flight():
+    return SingleFlight()
+
+# Fingerprint of a request: what is called and every parameter sent with it
+def request_fingerprint(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+# Call an OpenAI endpoint through its raw-response wrapper so tokens, bytes and SDK retries can be recorded.
+# Identical concurrent requests (same stage, prompt and parameters) share one call.
+def call_openai(stage, method, **kwargs):
+    flights = get_single_flight()
+    quota = get_quota_schedulers()["openai"]
+    key = ("openai", request_fingerprint(stage, kwargs))
+    
+    def request():
+        estimate = openai_token_estimate(kwargs)
+        quota.acquire({"requests": 1, "tokens": estimate}, lambda: flights.priority(key))
+        start = time.perf_counter()
+        try:
+            raw = method(**kwargs)
+        except Exception:
+            record_provider_call(stage, time.perf_counter() - start, outcome="error")
+            raise
+        result = raw.parse()
+        usage = getattr(result, "usage", None)
+        if usage:
+            quota.release({"tokens": estimate - usage.prompt_tokens - usage.completion_tokens})
+        record_provider_call(
+            stage, time.perf_counter() - start,
+            prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+            completion_tokens=getattr(usage, "completion_tokens", 0) or 0,
+            response_bytes=len(raw.content),
+            retries=getattr(raw, "retries_taken", 0)
+        )
+        return result
+    
+    start = time.perf_counter()
+    result, shared = flights.do(key, request, current_priority(), quota.wake)
+    if shared:
+        record_provider_call(stage, time.perf_counter() - start, cache="coalesced")
+    return result
+
+# Riddle generation settings
+NUM_RIDDLES = int(os.getenv("NUM_RIDDLES", "4"))  # Riddles per adventure
+SECONDS_PER_RIDDLE = int(os.getenv("SECONDS_PER_RIDDLE", "75"))  # Time limit per riddle (4 riddles: 5 minutes)
+RIDDLES_AHEAD = int(os.getenv("RIDDLES_AHEAD", "2"))  # Riddles a game's pipeline may generate past the one being solved
+CONCURRENT_RIDDLES = os.getenv("CONCURRENT_RIDDLES", "1") == "1"
+RIDDLE_SIMILARITY_THRESHOLD = 0.6  # Ratio above which two riddles count as duplicates
+MAX_RIDDLE_REGENERATIONS = 2  # Extra attempts per riddle when it is too similar to another
+RIDDLE_STAGE_ATTEMPTS = 3  # Tries per riddle stage before a failure shortens the adventure
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "16"))  # Threads shared by every generation pipeline
+PREFETCH_MAX_IN_FLIGHT = int(os.getenv("PREFETCH_MAX_IN_FLIGHT", "2"))  # Speculative narrations per session
+GENERATION_MODE = os.getenv("GENERATION_MODE", "text")  # "structured" asks for the whole adventure as one JSON payload
+ADVENTURE_TOKEN_BUDGET = int(os.getenv("ADVENTURE_TOKEN_BUDGET", "0"))  # Prompt + completion tokens per structured adventure; 0 scales with its riddles
+ADVENTURE_TOKENS_PER_RIDDLE = 600  # Default budget per riddle, plus one riddle's worth for the story (4 riddles: 3000 tokens)
+STRUCTURED_MAX_ATTEMPTS = 3  # Calls per structured adventure, counting the first one
+STRUCTURED_TOKENS_PER_RIDDLE = 150  # Completion tokens reserved for each riddle in a structured call
+
+# Generation service settings (python mindvault.py serve). The service must share DATA_DIR and the static folder.
+GENERATION_SERVICE_URL = os.getenv("GENERATION_SERVICE_URL")  # e.g. http://127.0.0.1:8503; generation runs in-process when unset
+GENERATION_SERVICE_HOST = os.getenv("GENERATION_SERVICE_HOST", "127.0.0.1")
+GENERATION_SERVICE_PORT = int(os.getenv("GENERATION_SERVICE_PORT", "8503"))
+GENERATION_SERVICE_WORKERS = int(os.getenv("GENERATION_SERVICE_WORKERS", "8"))
+GENERATION_SERVICE_QUEUE_SIZE = int(os.getenv("GENERATION_SERVICE_QUEUE_SIZE", "64"))  # Jobs waiting beyond this are refused with 503
+GENERATION_SERVICE_TIMEOUT = float(os.getenv("GENERATION_SERVICE_TIMEOUT", "180"))  # Seconds the service gives a job, queueing included
+GENERATION_SERVICE_READ_MARGIN = 10.0  # Clients wait this much longer, so the service reports a slow job before they give up
+GENERATION_SERVICE_RETRY_STATUS_CODES = {503}  # Only a full queue is retried; a failed job is not run again
+
+# Answer matching settings
+ANSWER_DETERMINERS = {"a", "an", "the", "some", "your", "my", "his", "her", "its", "their", "our"}
+ANSWER_SEPARATORS = r",|;|/|\(|\)|\bor\b"  # Model answers like "piano (or keyboard)" list several accepted answers
+ANSWER_SUBSTITUTION_MIN_LENGTH = 6  # Shorter answers tolerate a missing or extra letter, but not a wrong one
+
+# JSON schemas for the structured generation mode
+RIDDLE_SCHEMA = {
+    "type": "object",
+    "required": ["location", "riddle", "answer", "hint"],
+    "properties": {
+        "location": {"type": "string", "minLength": 1},
+        "riddle": {"type": "string", "minLength": 1},
+        "answer": {"type": "string", "minLength": 1},
+        "synonyms": {"type": "array"},
+        "hint": {"type": "string", "minLength": 1}
+    }
+}
+ADVENTURE_SCHEMA = {
+    "type": "object",
+    "required": ["main_story", "riddles"],
+    "properties": {
+        "main_story": {"type": "string", "minLength": 1},
+        "riddles": {"type": "array", "items": RIDDLE_SCHEMA}
+    }
+}
+RIDDLES_SCHEMA = {
+    "type": "object",
+    "required": ["riddles"],
+    "properties": {"riddles": {"type": "array", "items": RIDDLE_SCHEMA}}
+}
+
+# Normalize an answer to lowercase words without punctuation or leading articles
+def normalize_answer(text):
+    words = re.findall(r"[a-z0-9]+", text.lower().replace("'", ""))
+    while len(words) > 1 and words[0] in ANSWER_DETERMINERS:
+        words = words[1:]
+    return " ".join(words)
+
+# Crude English stemmer, enough to match plurals and simple verb forms
+def stem_word(word):
+    if len(word) <= 3:
+        return word
+    for suffix, replacement in (("ies", "y"), ("ves", "f"), ("sses", "ss"), ("xes", "x"), ("ches", "ch"), ("shes", "sh"),
+                                ("oes", "o"), ("ing", ""), ("ed", ""), ("s", "")):
+        if word.endswith(suffix) and not word.endswith("ss") and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)] + replacement
+    return word
+
+def stem_answer(normalized):
+    return " ".join(stem_word(word) for word in normalized.split())
+
+# Typos tolerated for an answer of this length
+def answer_distance_limit(form):
+    length = len(form.replace(" ", ""))
+    return 0 if length <= 4 else 1 if length <= 8 else 2
+
+# Levenshtein distance, giving up as soon as it exceeds limit
+def edit_distance(first, second, limit):
+    if abs(len(first) - len(second)) > limit:
+        return limit + 1
+    previous = list(range(len(second) + 1))
+    for i, first_char in enumerate(first, 1):
+        current = [i]
+        for j, second_char in enumerate(second, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (first_char != second_char)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+# Build the lookup used to check submissions: every accepted form (normalized and stemmed)
+# plus the normalized forms that allow typos, with how many edits each one tolerates
+def build_answer_index(answer, synonyms=()):
+    forms = set()
+    fuzzy = {}
+    for candidate in re.split(ANSWER_SEPARATORS, answer) + list(synonyms):
+        normalized = normalize_answer(candidate)
+        if not normalized:
+            continue
+        forms.update((normalized, stem_answer(normalized)))
+        if answer_distance_limit(normalized):
+            fuzzy[normalized] = answer_distance_limit(normalized)
+    return {"forms": frozenset(forms), "fuzzy": tuple(fuzzy.items())}
+
+# Check whether a submission is a tolerated typo of an answer form: within the form's edit limit, with the
+# first letter right (so "candle" does not pass for "handle"), and for short forms only a missing or extra
+# letter rather than a different one (so "rover" does not pass for "river")
+def typo_matches(normalized, form, limit):
+    if normalized[0] != form[0] or edit_distance(normalized, form, limit) > limit:
+        return False
+    return len(form.replace(" ", "")) >= ANSWER_SUBSTITUTION_MIN_LENGTH or len(normalized) != len(form)
+
+# Check a submission against a riddle's answer index
+def answer_matches(answer_index, submission):
+    normalized = normalize_answer(submission)
+    if not normalized:
+        return False
+    stemmed = stem_answer(normalized)
+    # Stemming is crude, so a plain plural ("shoes") is also tried with just its "s" dropped
+    if any(form in answer_index["forms"] for form in (normalized, stemmed, re.sub(r"s\b", "", normalized))):
+        return True
+    return any(typo_matches(normalized, form, limit) for form, limit in answer_index["fuzzy"])
+
+# Function to parse the storyline response into its sections
+def parse_storyline(storyline_result, num_riddles):
+    story_sections = {"Main_Story": ""}
+    current_section = "Main_Story"
+    
+    for line in storyline_result.split('\n'):
+        if any(f"Location_{i}:" in line for i in range(1, num_riddles+1)):
+            current_section = line.split(':')[0].strip()
+            story_sections[current_section] = line.split(':', 1)[1].strip() if ':' in line else ""
+        elif "Main_Story:" in line:
+            current_section = "Main_Story"
+            story_sections[current_section] = line.split(':', 1)[1].strip() if ':' in line else ""
+        else:
+            story_sections[current_section] += " " + line.strip()
+    
+    return story_sections
+
+# Function to parse a riddle response into riddle, answer and hint
+def parse_riddle(result, location):
+    riddle_parts = {}
+    current_part = None
+    
+    for line in result.split('\n'):
+        if line.startswith('Riddle:'):
+            current_part = 'riddle'
+            riddle_parts[current_part] = line.replace('Riddle:', '').strip()
+        elif line.startswith('Answer:'):
+            current_part = 'answer'
+            riddle_parts[current_part] = line.replace('Answer:', '').strip().lower()
+        elif line.startswith('Synonyms:'):
+            current_part = 'synonyms'
+            riddle_parts[current_part] = line.replace('Synonyms:', '').strip()
+        elif line.startswith('Hint:'):
+            current_part = 'hint'
+            riddle_parts[current_part] = line.replace('Hint:', '').strip()
+        elif current_part:
+            riddle_parts[current_part] += ' ' + line.strip()
+    
+    answer = riddle_parts.get('answer', "unknown")
+    synonyms = [synonym.strip() for synonym in riddle_parts.get('synonyms', "").split(',')
+                if synonym.strip() and synonym.strip().lower() not in ("none", "n/a")]
+    return {
+        "location": location,
+        "riddle": riddle_parts.get('riddle', "A challenging riddle awaits..."),
+        "answer": answer,
+        "synonyms": synonyms,
+        "answer_index": build_answer_index(answer, synonyms),
+        "hint": riddle_parts.get('hint', "Look carefully at the wording of the riddle.")
+    }
+
+# Function to generate a single riddle for one location
+def generate_riddle(theme, location, previous_riddles=""):
+    riddle_prompt = f"""Create a fun and engaging riddle for this escape room location: {location}
+        The theme is: {theme}
+        The riddle should be tricky but solvable and MUST BE DIFFERENT from any previous riddles.
+        {previous_riddles}
+        Format your response as:
+        Riddle: [your riddle here]
+        Answer: [clear answer]
+        Synonyms: [other words that should also count as correct, comma separated, or none]
+        Hint: [specific, helpful hint]"""
+    
+    response = call_openai(
+        "riddle", get_openai_client().chat.completions.with_raw_response.create,
+        model="gpt-3.5-turbo",
+        messages=[{"role": "system", "content": "You are creating unique, challenging riddles for each part of an escape room."},
+                  {"role": "user", "content": riddle_prompt}],
+        temperature=0.8,
+        max_tokens=250
+    )
+    
+    return parse_riddle(response.choices[0].message.content.strip(), location)
+
+# Normalize text to lowercase words for similarity checks
+def normalize_words(text):
+    return " ".join(re.findall(r"[a-z0-9']+", text.lower()))
+
+# Check whether two riddles are too similar (same answer or near-identical wording)
+def riddles_too_similar(first, second):
+    if first["answer"] != "unknown" and normalize_words(first["answer"]) == normalize_words(second["answer"]):
+        return True
+    ratio = difflib.SequenceMatcher(None, normalize_words(first["riddle"]), normalize_words(second["riddle"])).ratio()
+    return ratio >= RIDDLE_SIMILARITY_THRESHOLD
+
+# Function to generate the storyline, returning the main story and one location per riddle
+def generate_storyline(theme, num_riddles):
+    # Create a storyline that connects all riddles
+    storyline_prompt = f"""Create a short, engaging escape room storyline related to the theme: {theme}.
+    The story should connect {num_riddles} different locations or challenges, each with its own riddle.
+    Make the storyline cohesive but each location/challenge distinct.
+    Format your response as:
+    Main_Story: [brief overall story]
+    """ + "\n    ".join(f"Location_{i}: [location {i} name: challenge description]" for i in range(1, num_riddles+1))
+    
+    story_response = call_openai(
+        "storyline", get_openai_client().chat.completions.with_raw_response.create,
+        model="gpt-3.5-turbo",
+        messages=[{"role": "system", "content": "You are creating an immersive escape room adventure."},
+                  {"role": "user", "content": storyline_prompt}],
+        temperature=0.7,
+        max_tokens=max(500, 125 * num_riddles)
+    )
+    
+    storyline_result = story_response.choices[0].message.content.strip()
+    
+    # Parse storyline sections
+    story_sections = parse_storyline(storyline_result, num_riddles)
+    locations = [story_sections.get(f"Location_{i}", f"Challenge {i}") for i in range(1, num_riddles+1)]
+    return story_sections["Main_Story"], locations
+
+# Prompt section listing the earlier riddles (used by the sequential mode)
+def previous_riddles_prompt(riddles):
+    if not riddles:
+        return ""
+    previous_riddles = "Previous riddles generated (make this one different):\n"
+    for j, prev_riddle in enumerate(riddles):
+        previous_riddles += f"Riddle {j+1}: {prev_riddle['riddle']}\n"
+    return previous_riddles
+
+# Prompt section naming the earlier riddles a regenerated riddle must not repeat
+def clashing_riddles_prompt(riddles):
+    clashing = "This riddle must not repeat these earlier riddles or their answers:\n"
+    for riddle in riddles:
+        clashing += f"Riddle: {riddle['riddle']} (Answer: {riddle['answer']})\n"
+    return clashing
+
+# Regenerate a riddle while it duplicates one of the earlier riddles. Only the retries name the riddles it
+# clashed with, so the first drafts can still be written in parallel.
+def ensure_distinct_riddle(theme, riddle, earlier_riddles):
+    avoid = []
+    for attempt in range(MAX_RIDDLE_REGENERATIONS + 1):
+        clashes = [earlier for earlier in earlier_riddles if riddles_too_similar(riddle, earlier)]
+        if not clashes:
+            return riddle
+        if attempt == MAX_RIDDLE_REGENERATIONS:
+            break
+        avoid += [clash for clash in clashes if clash not in avoid]
+        riddle = generate_riddle(theme, riddle["location"], clashing_riddles_prompt(avoid))
+    logger.warning("Keeping a riddle for %s that is still similar to an earlier one: %s", riddle["location"], riddle["riddle"])
+    return riddle
+
+# Check a JSON value against the subset of JSON Schema used above, returning a list of problems
+def schema_errors(value, schema, path="$"):
+    # Array items are left to the caller so one bad riddle does not reject the others
+    expected = {"object": dict, "array": list, "string": str}[schema["type"]]
+    if not isinstance(value, expected):
+        return [f"{path} is not of type {schema['type']}"]
+    if schema["type"] == "string":
+        return [f"{path} is empty"] if len(value.strip()) < schema.get("minLength", 0) else []
+    errors = []
+    if schema["type"] == "object":
+        for key in schema.get("required", []):
+            if key not in value:
+                errors.append(f"{path}.{key} is missing")
+        for key, child in schema.get("properties", {}).items():
+            if key in value:
+                errors.extend(schema_errors(value[key], child, f"{path}.{key}"))
+    return errors
+
+# Call the chat model in JSON mode within what is left of the token budget; returns the payload (None if invalid) and the tokens spent
+def structured_chat(stage, prompt, tokens_left, completion_tokens):
+    messages = [{"role": "system", "content": "You are creating an immersive escape room adventure. Reply with JSON only."},
+                {"role": "user", "content": prompt}]
+    prompt_estimate = sum(len(message["content"]) for message in messages) // 4 + 10
+    max_tokens = min(completion_tokens, tokens_left - prompt_estimate)
+    if max_tokens < STRUCTURED_TOKENS_PER_RIDDLE:
+        raise RuntimeError("Adventure token budget exhausted")
+    
+    response = call_openai(
+        stage, get_openai_client().chat.completions.with_raw_response.create,
+        model="gpt-3.5-turbo",
+        messages=messages,
+        response_format={"type": "json_object"},
+        temperature=0.8,
+        max_tokens=max_tokens
+    )
+    usage = response.usage
+    spent = (usage.prompt_tokens + usage.completion_tokens) if usage else prompt_estimate + max_tokens
+    try:
+        return json.loads(response.choices[0].message.content), spent
+    except (TypeError, ValueError):
+        return None, spent
+
+# Turn a schema-checked riddle object into the riddle dict used by the game
+def structured_riddle(item, location):
+    answer = item["answer"].strip().lower()
+    synonyms = [synonym.strip() for synonym in item.get("synonyms", []) if isinstance(synonym, str) and synonym.strip()]
+    return {
+        "location": location,
+        "riddle": item["riddle"].strip(),
+        "answer": answer,
+        "synonyms": synonyms,
+        "answer_index": build_answer_index(answer, synonyms),
+        "hint": item["hint"].strip()
+    }
+
+# Fill the empty riddle slots from a list of generated riddle objects, skipping invalid or duplicate ones
+def fill_riddle_slots(riddles, locations, items):
+    missing = [i for i, riddle in enumerate(riddles) if riddle is None]
+    for i, item in zip(missing, items):
+        # Keep the location even when the riddle is rejected so the retry asks for the same place
+        if not locations[i] and isinstance(item, dict) and isinstance(item.get("location"), str) and item["location"].strip():
+            locations[i] = item["location"].strip()
+        errors = schema_errors(item, RIDDLE_SCHEMA, f"$.riddles[{i}]")
+        if errors:
+            logger.warning("Discarding structured riddle: %s", "; ".join(errors))
+            continue
+        riddle = structured_riddle(item, locations[i])
+        if any(other is not None and riddles_too_similar(riddle, other) for other in riddles):
+            logger.warning("Discarding structured riddle %d: too similar to another riddle", i + 1)
+            continue
+        riddles[i] = riddle
+
+# Function to generate the story and every riddle in one JSON call, re-asking only for the riddles that failed the schema
+def generate_structured_adventure(theme, num_riddles, token_budget=None):
+    token_budget = token_budget or ADVENTURE_TOKEN_BUDGET or ADVENTURE_TOKENS_PER_RIDDLE * (num_riddles + 1)
+    compact_schema = json.dumps(ADVENTURE_SCHEMA, separators=(",", ":"))
+    prompt = f"""Create an escape room adventure for the theme: {theme}.
+    Write a brief main story connecting {num_riddles} distinct locations, each with one tricky but solvable riddle.
+    Every riddle and answer must be different; answers are one or two words, with other accepted words in synonyms.
+    Reply with a JSON object matching this schema, with exactly {num_riddles} riddles:
+    {compact_schema}"""
+    
+    tokens_left = token_budget
+    main_story = None
+    locations = [None] * num_riddles
+    riddles = [None] * num_riddles
+    for _ in range(STRUCTURED_MAX_ATTEMPTS):
+        missing = [i for i, riddle in enumerate(riddles) if riddle is None]
+        if main_story is None:
+            payload, spent = structured_chat("adventure", prompt, tokens_left,
+                                             STRUCTURED_TOKENS_PER_RIDDLE * num_riddles + 200)
+            tokens_left -= spent
+            errors = schema_errors(payload, ADVENTURE_SCHEMA) if payload is not None else ["$ is not valid JSON"]
+            if errors:
+                logger.warning("Structured adventure failed the schema: %s", "; ".join(errors))
+                continue
+            main_story = payload["main_story"].strip()
+            items = payload["riddles"]
+        else:
+            # Only the failed riddles are asked for again, with the story and the answers already in use
+            taken = ", ".join(riddle["answer"] for riddle in riddles if riddle is not None)
+            wanted = "\n".join(f"- {locations[i] or f'Challenge {i + 1}'}" for i in missing)
+            repair_prompt = f"""Escape room theme: {theme}. Story: {main_story}
+    Write one new riddle for each of these locations, in this order:
+    {wanted}
+    Answers must differ from: {taken or "none"}.
+    Reply with a JSON object matching this schema, with exactly {len(missing)} riddles:
+    {json.dumps(RIDDLES_SCHEMA, separators=(",", ":"))}"""
+            payload, spent = structured_chat("riddle_repair", repair_prompt, tokens_left,
+                                             STRUCTURED_TOKENS_PER_RIDDLE * len(missing) + 50)
+            tokens_left -= spent
+            errors = schema_errors(payload, RIDDLES_SCHEMA) if payload is not None else ["$ is not valid JSON"]
+            if errors:
+                logger.warning("Structured riddles failed the schema: %s", "; ".join(errors))
+                continue
+            items = payload["riddles"]
+        
+        fill_riddle_slots(riddles, locations, items)
+        if all(riddle is not None for riddle in riddles):
+            break
+    
+    if main_story is None or any(riddle is None for riddle in riddles):
+        raise RuntimeError("Structured adventure generation failed")
+    logger.info("Structured adventure used %d of %d tokens", token_budget - tokens_left, token_budget)
+    return main_story, locations, riddles
+
+# Narration segments for a riddle: fixed lead-ins (synthesized once) and the riddle's own text
+def riddle_narration_segments(riddle):
+    return [LOCATION_LEAD_IN, f"{riddle['location']}.", RIDDLE_LEAD_IN, riddle['riddle']]
+
+def hint_narration_segments(riddle):
+    return [HINT_LEAD_IN, riddle['hint']]
+
+# Text read out for a riddle
+def riddle_narration(riddle):
+    return " ".join(riddle_narration_segments(riddle))
+
+# Runs named stages on a thread pool, starting each one as soon as the stages it depends on have finished
+class StageScheduler:
+    def __init__(self, executor, priority="generation"):
+        self.executor = executor
+        self.context = capture_call_context(priority=priority)
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.cancelled = False
+
+    # Add a stage; func is called with the results of its dependencies, in order, up to attempts times while it fails
+    def add(self, name, func, deps=(), attempts=1):
+        future = Future()
+        dep_futures = [self.futures[dep] for dep in deps]
+        self.futures[name] = future
+        remaining = [len(dep_futures)]
+
+        def run(args):
+            if not future.set_running_or_notify_cancel():
+                return
+            for attempt in range(attempts):
+                try:
+                    result = run_in_context(self.context, func, *args)
+                except Exception as e:
+                    if attempt + 1 < attempts and not self.cancelled:
+                        logger.warning("Stage %s failed, retrying: %s", name, e)
+                        time.sleep(backoff_delay(attempt))
+                        continue
+                    future.set_exception(e)
+                    return
+                future.set_result(result)
+                return
+
+        def launch():
+            try:
+                args = [dep.result() for dep in dep_futures]
+            except BaseException as e:
+                # A failed or cancelled dependency fails every stage after it
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+                return
+            try:
+                self.executor.submit(run, args)
+            except RuntimeError as e:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+
+        def on_dependency_done(_):
+            with self.lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if ready:
+                launch()
+
+        if not dep_futures:
+            launch()
+        for dep in dep_futures:
+            dep.add_done_callback(on_dependency_done)
+        return future
+
+    # Add a stage that finishes only when open() is called, to hold the stages that depend on it back
+    def add_gate(self, name):
+        self.futures[name] = Future()
+
+    def open(self, name):
+        future = self.futures.get(name)
+        if future is not None and not future.done() and future.set_running_or_notify_cancel():
+            future.set_result(None)
+
+    def has(self, name):
+        return name in self.futures
+
+    def ready(self, name):
+        return name in self.futures and self.futures[name].done()
+
+    # Wait for a stage and return its result, re-raising its exception
+    def result(self, name, timeout=None):
+        return self.futures[name].result(timeout)
+
+    # Remove a finished stage and return its result
+    def take(self, name):
+        return self.futures.pop(name).result()
+
+    def cancel(self):
+        self.cancelled = True
+        for future in self.futures.values():
+            future.cancel()
+
+# Worker threads that run the stages of every generation pipeline
+@shared
+def get_generation_executor():
+    return ThreadPoolExecutor(max_workers=GENERATION_WORKERS, thread_name_prefix="generation")
+
+# Schedule the adventure stages: image and storyline start at once, each riddle as soon as the
+# storyline (and, for duplicate checks, the earlier riddles) are ready, narration once its text exists.
+# In structured mode the storyline and riddles all come from one "adventure" stage.
+# narrate lists the audio to synthesize, using the session audio keys ("intro", "riddle_0", ...).
+# A resumed game passes its storyline and the riddles it already has; only the missing riddles are generated.
+# With ahead set, riddle i (and its narration) waits until the "reached_{i - ahead}" gate is opened, i.e. until the
+# player reaches riddle i - ahead, so a long adventure is generated while it is played rather than up front.
+def start_adventure_pipeline(theme, num_riddles=NUM_RIDDLES, concurrent=CONCURRENT_RIDDLES, image=True, narrate=(),
+                             mode=GENERATION_MODE, priority="generation", storyline=None, riddles=(), ahead=None):
+    pipeline = StageScheduler(get_generation_executor(), priority)
+    whole_adventure = storyline is None and (GENERATION_SERVICE_URL or mode == "structured")
+    if image:
+        pipeline.add("image", lambda: generate_image(theme))
+    if storyline is not None:
+        pipeline.add("storyline", lambda: storyline)
+    elif GENERATION_SERVICE_URL:
+        pipeline.add("adventure", lambda: request_adventure(theme, num_riddles, mode))
+        pipeline.add("storyline", lambda adventure: adventure[:2], ["adventure"])
+    elif mode == "structured":
+        pipeline.add("adventure", lambda: generate_structured_adventure(theme, num_riddles))
+        pipeline.add("storyline", lambda adventure: adventure[:2], ["adventure"])
+    else:
+        pipeline.add("storyline", lambda: generate_storyline(theme, num_riddles))
+    if "intro" in narrate:
+        pipeline.add("audio:intro", lambda storyline: text_to_speech(storyline[0]) if storyline[0] else None, ["storyline"])
+    
+    for i in range(num_riddles):
+        earlier = [f"riddle_{j}" for j in range(i)]
+        gate = []
+        if ahead is not None and i > ahead and i >= len(riddles) and not whole_adventure:
+            pipeline.add_gate(f"reached_{i - ahead}")
+            gate = [f"reached_{i - ahead}"]
+        if i < len(riddles):
+            pipeline.add(f"riddle_{i}", lambda riddle=riddles[i]: riddle)
+        elif whole_adventure:
+            pipeline.add(f"riddle_{i}", lambda adventure, i=i: adventure[2][i], ["adventure"])
+        elif concurrent:
+            # Riddles are drafted in parallel and checked locally against the earlier ones
+            pipeline.add(f"draft_{i}", lambda storyline, *_, i=i: generate_riddle(theme, storyline[1][i]), ["storyline"] + gate,
+                         attempts=RIDDLE_STAGE_ATTEMPTS)
+            pipeline.add(f"riddle_{i}", lambda draft, *earlier_riddles: ensure_distinct_riddle(theme, draft, earlier_riddles),
+                         [f"draft_{i}"] + earlier, attempts=RIDDLE_STAGE_ATTEMPTS)
+        else:
+            # Each riddle prompt shows the model every earlier riddle
+            pipeline.add(f"riddle_{i}", lambda storyline, *earlier_riddles, i=i: generate_riddle(theme, storyline[1][i], previous_riddles_prompt(earlier_riddles[:i])),
+                         ["storyline"] + earlier + gate, attempts=RIDDLE_STAGE_ATTEMPTS)
+        if f"riddle_{i}" in narrate:
+            pipeline.add(f"audio:riddle_{i}", lambda riddle: narration_to_speech(riddle_narration_segments(riddle)), [f"riddle_{i}"])
+    
+    return pipeline
+
+# Folder holding the cached background images for a theme
+def theme_image_dir(theme):
+    slug = re.sub(r"[^a-z0-9]+", "-", theme.lower()).strip("-")
+    return os.path.join(STATIC_IMAGE_DIR, slug), f"{STATIC_IMAGE_URL}/{slug}"
+
+# Download an image once and store compressed variants under its content hash
+def cache_image(theme, image_url):
+    start = time.perf_counter()
+    response = get_http_session().get(image_url, timeout=(TTS_CONNECT_TIMEOUT, TTS_READ_TIMEOUT))
+    response.raise_for_status()
+    record_provider_call("image_download", time.perf_counter() - start, response_bytes=len(response.content))
+    image_hash = hashlib.sha256(response.content).hexdigest()[:32]
+    theme_dir, theme_url = theme_image_dir(theme)
+    image_dir = os.path.join(theme_dir, image_hash)
+    
+    if not os.path.isdir(image_dir):
+        image = Image.open(io.BytesIO(response.content)).convert("RGB")
+        tmp_dir = f"{image_dir}.{threading.get_ident()}.tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        for width in IMAGE_WIDTHS:
+            height = round(image.height * width / image.width)
+            resized = image.resize((width, height), Image.LANCZOS) if width < image.width else image
+            for extension, options in IMAGE_FORMATS.items():
+                resized.save(os.path.join(tmp_dir, f"{width}.{extension}"), **options)
+        try:
+            os.replace(tmp_dir, image_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)  # Another worker cached the same image first
+    
+    return f"{theme_url}/{image_hash}"
+
+# Pick one of the images already cached for the theme, if there are enough of them
+def cached_theme_image(theme):
+    theme_dir, theme_url = theme_image_dir(theme)
+    if not os.path.isdir(theme_dir):
+        return None
+    image_hashes = [entry.name for entry in os.scandir(theme_dir) if entry.is_dir() and not entry.name.endswith(".tmp")]
+    if len(image_hashes) < IMAGES_PER_THEME:
+        return None
+    return f"{theme_url}/{random.choice(image_hashes)}"
+
+# Function to generate images using DALL·E
+def generate_image(theme):
+    cached_image = cached_theme_image(theme)
+    if cached_image:
+        record_provider_call("image", 0, cache="hit")
+        return cached_image
+    if GENERATION_SERVICE_URL:
+        return call_generation_service("generate-image", {"theme": theme}).json()["url"]
+    
+    response = call_openai(
+        "image", get_openai_client().images.with_raw_response.generate,
+        prompt=f"Create an immersive {theme} setting, with rich details and light colors suitable for a background for an escape room.",
+        n=1,
+        size="1024x1024"
+    )
+    image_url = response.data[0].url
+    try:
+        return cache_image(theme, image_url)
+    except Exception as e:
+        # Fall back to the temporary remote URL
+        logger.warning("Could not cache background image for %s: %s", theme, e)
+        return image_url
+
+# Circuit breaker: after repeated failures, skip calls to a provider until it has had time to recover
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    # Closed or half-open (reset timeout elapsed) breakers let calls through
+    def allow(self):
+        with self.lock:
+            return self.opened_at is None or time.time() - self.opened_at >= self.reset_timeout
+
+    def is_open(self):
+        return not self.allow()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+
+# ElevenLabs breaker; while open, narration is off for every session
+@shared
+def get_tts_breaker():
+    return CircuitBreaker()
+
+# Requests session with a keep-alive connection pool
+@shared
+def get_http_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# Jittered exponential backoff, honouring Retry-After when the provider sends one
+def backoff_delay(attempt, response=None):
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), HTTP_BACKOFF_MAX)
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt))
+
+# POST with connect/read deadlines and bounded retries on the retry statuses (429 and 5xx by default) and
+# connection errors. With retry_read_timeouts off, a request the server may still be working on is not sent again.
+def post_with_retries(url, breaker=None, timeout=(TTS_CONNECT_TIMEOUT, TTS_READ_TIMEOUT), retry_statuses=RETRY_STATUS_CODES,
+                      retry_read_timeouts=True, **kwargs):
+    if breaker and not breaker.allow():
+        raise requests.exceptions.ConnectionError(f"Circuit open for {url}")
+    session = get_http_session()
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        response = None
+        try:
+            response = session.post(url, timeout=timeout, **kwargs)
+            if response.status_code not in retry_statuses:
+                response.raise_for_status()
+                if breaker:
+                    breaker.record_success()
+                response.retries = attempt  # Read by the instrumentation
+                return response
+            if attempt == HTTP_MAX_RETRIES:
+                response.raise_for_status()
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt == HTTP_MAX_RETRIES or (isinstance(e, requests.exceptions.ReadTimeout) and not retry_read_timeouts):
+                if breaker:
+                    breaker.record_failure()
+                raise
+        except requests.exceptions.HTTPError as e:
+            # Retryable statuses only reach here after the last attempt; count them against the provider
+            if breaker and e.response is not None and e.response.status_code in retry_statuses:
+                breaker.record_failure()
+            raise
+        if response is not None:
+            response.close()
+        time.sleep(backoff_delay(attempt, response))
+
+# Clips are MP3 unless their key carries another extension ("<hash>.ogg" for Opus, "<hash>.wav" for local fallback clips)
+def audio_file_name(key):
+    return key if key.endswith((".ogg", ".wav")) else f"{key}.mp3"
+
+def audio_key(file_name):
+    return file_name if file_name.endswith((".ogg", ".wav")) else file_name[:-len(".mp3")]
+
+def audio_mime_type(key):
+    return AUDIO_MIME_TYPES[os.path.splitext(audio_file_name(key))[1]]
+
+# On-disk audio cache keyed by content hash, evicting least recently used clips over a byte budget
+class AudioCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> size in bytes, least recently used first
+        self.pins = {}  # key -> number of holders; pinned entries are never evicted
+        os.makedirs(directory, exist_ok=True)
+        files = [entry for entry in os.scandir(directory) if entry.name.endswith(tuple(AUDIO_MIME_TYPES))]
+        for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+            self.entries[audio_key(entry.name)] = entry.stat().st_size
+        self.total_bytes = sum(self.entries.values())
+
+    def _path(self, key):
+        return os.path.join(self.directory, audio_file_name(key))
+
+    def contains(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def size(self, key):
+        with self.lock:
+            return self.entries.get(key, 0)
+
+    def pin(self, key):
+        with self.lock:
+            self.pins[key] = self.pins.get(key, 0) + 1
+
+    def unpin(self, key):
+        with self.lock:
+            if self.pins.get(key, 0) > 1:
+                self.pins[key] -= 1
+            else:
+                self.pins.pop(key, None)
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                # Another process sharing the folder (the generation service) may have written it since startup
+                try:
+                    size = os.path.getsize(self._path(key))
+                except OSError:
+                    return None
+                self.total_bytes += size
+                self.entries[key] = size
+            self.entries.move_to_end(key)
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+            os.utime(self._path(key))  # Keep LRU order across restarts
+            return data
+        except OSError:
+            with self.lock:
+                self.total_bytes -= self.entries.pop(key, 0)
+            return None
+
+    def put(self, key, data):
+        tmp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key))
+        with self.lock:
+            self.total_bytes += len(data) - self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            for old_key in list(self.entries):
+                if self.total_bytes <= self.max_bytes:
+                    break
+                if old_key == key or old_key in self.pins:
+                    continue
+                self.total_bytes -= self.entries.pop(old_key)
+                try:
+                    os.remove(self._path(old_key))
+                except OSError:
+                    pass
+
+@shared
+def get_audio_cache():
+    return AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES)
+
+# Hash everything that affects the synthesized audio
+def tts_cache_key(text, voice_id=ELEVENLABS_VOICE_ID, model_id=ELEVENLABS_MODEL_ID, voice_settings=ELEVENLABS_VOICE_SETTINGS, profile="original"):
+    output_format = AUDIO_PROFILES[profile]["output_format"]
+    fingerprint = [text, voice_id, model_id, voice_settings] + ([output_format] if output_format else [])
+    key = hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+    extension = AUDIO_PROFILES[profile]["extension"]
+    return key if extension == ".mp3" else key + extension
+
+# Build the ElevenLabs request for the given text
+def tts_request(text, stream=False, profile="original"):
+    url = f"{ELEVENLABS_API_URL}/text-to-speech/{ELEVENLABS_VOICE_ID}"
+    if stream:
+        url += "/stream"
+    if AUDIO_PROFILES[profile]["output_format"]:
+        url += f"?output_format={AUDIO_PROFILES[profile]['output_format']}"
+    headers = {"xi-api-key": ELEVENLABS_API_KEY, "Content-Type": "application/json"}
+    data = {
+        "text": text,
+        "model_id": ELEVENLABS_MODEL_ID,
+        "voice_settings": ELEVENLABS_VOICE_SETTINGS
+    }
+    return url, headers, data
+
+# Threads for the ElevenLabs leg of hedged narration. They are kept apart from the generation workers, which
+# wait on hedged narration themselves and would otherwise queue the remote call behind their own stages.
+@shared
+def get_tts_hedge_executor():
+    return ThreadPoolExecutor(max_workers=TTS_HEDGE_WORKERS, thread_name_prefix="tts-hedge")
+
+# Seconds of the latency budget left for the narration being synthesized on this thread. Stitched narration
+# sets one deadline for all its segments, so the player waits at most one budget before the fallback.
+def tts_time_left():
+    deadline = getattr(call_context, "tts_deadline", None)
+    return TTS_LATENCY_BUDGET if deadline is None else max(0.0, deadline - time.monotonic())
+
+# ElevenLabs TTS Function
+def text_to_speech(text):
+    audio_cache = get_audio_cache()
+    profile = current_audio_profile()
+    cache_key = tts_cache_key(text, profile=profile)
+    start = time.perf_counter()
+    cached_audio = audio_cache.get(cache_key)
+    if cached_audio:
+        record_provider_call("tts", time.perf_counter() - start, cache="hit", response_bytes=len(cached_audio))
+        return cached_audio
+    
+    # Players asking for the same narration at the same time share one synthesis
+    def synthesize():
+        audio, shared = get_single_flight().do(("tts", cache_key), lambda: synthesize_speech(text, profile, cache_key, start),
+                                               current_priority(), get_quota_schedulers()["elevenlabs"].wake)
+        if shared:
+            record_provider_call("tts", time.perf_counter() - start, cache="coalesced", response_bytes=len(audio or b""))
+        return audio
+    
+    # Background work can wait for ElevenLabs; anything a player is waiting on is hedged with the local engine
+    if not TTS_LATENCY_BUDGET or current_priority() == "background" or not local_speech_engine():
+        return synthesize()
+    remote = get_tts_hedge_executor().submit(run_in_context, capture_call_context(), synthesize)
+    try:
+        audio = remote.result(timeout=tts_time_left())
+    except FutureTimeoutError:
+        audio = None  # The remote call keeps running and fills the audio cache when it finishes
+    if audio:
+        return audio
+    audio = local_text_to_speech(text)
+    record_provider_call("tts", time.perf_counter() - start, cache="fallback", outcome="ok" if audio else "error",
+                         response_bytes=len(audio or b""))
+    return audio
+
+# Synthesize a clip that is not in the audio cache and store it there
+def synthesize_speech(text, profile, cache_key, start):
+    if GENERATION_SERVICE_URL:
+        try:
+            audio = call_generation_service("synthesize-speech", {"text": text, "profile": profile}).content
+        except requests.exceptions.RequestException as e:
+            logger.warning("Generation service could not synthesize speech: %s", e)
+            return None
+        get_audio_cache().put(cache_key, audio)  # The service wrote the same file; account for it in this process too
+        return audio
+    
+    # Narration is switched off for everyone while ElevenLabs is unhealthy
+    breaker = get_tts_breaker()
+    if not breaker.allow():
+        record_provider_call("tts", 0, cache="miss", outcome="circuit_open")
+        return None
+    
+    url, headers, data = tts_request(text, profile=profile)
+    # Quota is taken at the priority of the most urgent player waiting on this clip
+    get_quota_schedulers()["elevenlabs"].acquire({"characters": len(text)}, lambda: get_single_flight().priority(("tts", cache_key)))
+    
+    try:
+        response = post_with_retries(url, breaker=breaker, json=data, headers=headers)
+        get_audio_cache().put(cache_key, response.content)
+        record_provider_call("tts", time.perf_counter() - start, cache="miss",
+                             response_bytes=len(response.content), retries=response.retries)
+        return response.content
+    except requests.exceptions.RequestException as e:
+        record_provider_call("tts", time.perf_counter() - start, cache="miss", outcome="error")
+        logger.error("Error calling ElevenLabs API: %s", e)
+        return None
+
+# Offline speech engine used for hedged narration, or None when none is installed
+@shared
+def local_speech_engine():
+    candidates = ["espeak-ng", "espeak", "pyttsx3"] if TTS_FALLBACK_ENGINE == "auto" else [TTS_FALLBACK_ENGINE]
+    for engine in candidates:
+        if engine == "pyttsx3":
+            try:
+                import pyttsx3
+                return {"name": engine, "engine": pyttsx3.init(), "lock": threading.Lock()}
+            except Exception:  # Missing module or no system speech driver
+                continue
+        elif shutil.which(engine):
+            return {"name": engine, "command": shutil.which(engine)}
+    return None
+
+# Speak text with the local engine, returning WAV bytes (None on failure)
+def local_text_to_speech(text):
+    engine = local_speech_engine()
+    try:
+        if engine["name"] == "pyttsx3":
+            # pyttsx3 drives one engine per process and is not thread-safe
+            path = os.path.join(DATA_DIR, f"fallback-{uuid.uuid4().hex}.wav")
+            with engine["lock"]:
+                engine["engine"].save_to_file(text, path)
+                engine["engine"].runAndWait()
+            try:
+                with open(path, "rb") as f:
+                    return f.read()
+            finally:
+                os.remove(path)
+        result = subprocess.run([engine["command"], "--stdout"], input=text.encode(), capture_output=True,
+                                timeout=TTS_FALLBACK_TIMEOUT, check=True)
+        return result.stdout or None
+    except (OSError, subprocess.SubprocessError, RuntimeError) as e:
+        logger.warning("Local speech engine %s failed: %s", engine["name"], e)
+        return None
+
+# Bitrates (kbps) and sample rates (Hz) of MPEG Layer III, by MPEG version bits
+MP3_BITRATES = {3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+                2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]}
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+# Parse an MP3 frame header, returning (frame length, sample rate, channel mode) or None
+def mp3_frame_header(header):
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version, layer = (header[1] >> 3) & 3, (header[1] >> 1) & 3
+    bitrate_index, rate_index = header[2] >> 4, (header[2] >> 2) & 3
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    bitrate = MP3_BITRATES[3 if version == 3 else 2][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    length = (144 if version == 3 else 72) * bitrate // sample_rate + ((header[2] >> 1) & 1)
+    return length, sample_rate, header[3] >> 6
+
+# Complete audio frames of an MP3 clip as (start, end, format), skipping ID3 tags, junk and the Xing/Info header frame
+def mp3_frames(data):
+    position = 0
+    if data[:3] == b"ID3":
+        position = 10 + sum((byte & 0x7F) << (7 * (3 - i)) for i, byte in enumerate(data[6:10]))
+    frames = []
+    while position + 4 <= len(data):
+        header = mp3_frame_header(data[position:position + 4])
+        if header is None:
+            position += 1  # Resynchronize on the next frame header
+            continue
+        end = position + header[0]
+        if end > len(data):
+            break  # Truncated last frame
+        frame = data[position:end]
+        if frames or not any(tag in frame for tag in (b"Xing", b"Info", b"VBRI")):
+            frames.append((position, end, header[1:]))
+        position = end
+    return frames
+
+# Join MP3 clips frame by frame without re-encoding; None unless every clip is MP3 in the same format
+def join_mp3(clips):
+    joined = []
+    audio_format = None
+    for clip in clips:
+        # WAV and Ogg data can contain bytes that look like MP3 frame headers
+        if clip[:4] in (b"RIFF", b"OggS"):
+            return None
+        frames = mp3_frames(clip)
+        if not frames:
+            return None
+        for start, end, frame_format in frames:
+            if audio_format not in (None, frame_format):
+                return None
+            audio_format = frame_format
+            joined.append(clip[start:end])
+    return b"".join(joined)
+
+# Synthesize narration made of fixed and variable segments: each segment is synthesized (and cached)
+# on its own and the clips are joined, so the lead-ins are paid for once. The joined clip is cached
+# under the full text.
+def narration_to_speech(segments):
+    text = " ".join(segments)
+    if not NARRATION_STITCHING or AUDIO_PROFILES[current_audio_profile()]["extension"] != ".mp3":
+        return text_to_speech(text)
+    cache_key = tts_cache_key(text, profile=current_audio_profile())
+    cached_audio = get_audio_cache().get(cache_key)
+    if cached_audio:
+        record_provider_call("tts", 0, cache="hit", response_bytes=len(cached_audio))
+        return cached_audio
+    
+    # Segments are synthesized side by side; the lead-ins are normally cache hits
+    context = capture_call_context(tts_deadline=time.monotonic() + TTS_LATENCY_BUDGET)
+    with ThreadPoolExecutor(max_workers=len(segments), thread_name_prefix="narration-segment") as segment_pool:
+        clips = list(segment_pool.map(lambda segment: run_in_context(context, text_to_speech, segment), segments))
+    if not all(clips):
+        return None
+    audio = join_mp3(clips)
+    if audio is None:
+        # A segment came back in another format (e.g. a local fallback clip); narrate the text in one piece
+        return run_in_context(context, text_to_speech, text)
+    get_audio_cache().put(cache_key, audio)
+    return audio
+
+# One in-flight streaming synthesis; every listener reads the chunks received so far
+class NarrationStream:
+    def __init__(self, text, profile):
+        self.text = text
+        self.profile = profile
+        self.chunks = []
+        self.done = False
+        self.failed = False
+        self.condition = threading.Condition()
+
+    def append(self, chunk):
+        with self.condition:
+            self.chunks.append(chunk)
+            self.condition.notify_all()
+
+    def finish(self, failed=False):
+        with self.condition:
+            self.done = True
+            self.failed = failed
+            self.condition.notify_all()
+
+    # Yield chunks as they arrive until the stream is complete
+    def iter_chunks(self):
+        position = 0
+        while True:
+            with self.condition:
+                while position >= len(self.chunks) and not self.done:
+                    self.condition.wait()
+                if position >= len(self.chunks):
+                    return
+                chunk = self.chunks[position]
+            position += 1
+            yield chunk
+
+# Local HTTP endpoint that relays ElevenLabs streaming audio to the browser and fills the audio cache
+class NarrationStreamServer:
+    def __init__(self, audio_cache, breaker, host, port):
+        self.audio_cache = audio_cache
+        self.breaker = breaker
+        self.lock = threading.Lock()
+        self.pending = OrderedDict()  # cache key -> (text, profile, registration time) registered by a script run, oldest first
+        self.streams = {}  # cache key -> NarrationStream currently synthesizing
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                server.handle(self)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, name="tts-stream", daemon=True).start()
+
+    # Register the text and return the URL the browser should play
+    def url_for(self, text, profile):
+        cache_key = tts_cache_key(text, profile=profile)
+        if not self.audio_cache.contains(cache_key):
+            self._register(cache_key, text, profile)
+        return f"{TTS_STREAM_PUBLIC_URL}/narration/{audio_file_name(cache_key)}"
+
+    # Remember a narration the browser may ask for, forgetting expired ones and the oldest beyond the limit
+    def _register(self, cache_key, text, profile):
+        now = time.monotonic()
+        with self.lock:
+            self.pending.pop(cache_key, None)
+            self.pending[cache_key] = (text, profile, now)
+            while self.pending:
+                _, (_, _, registered) = next(iter(self.pending.items()))
+                if len(self.pending) <= TTS_STREAM_MAX_PENDING and now - registered <= TTS_STREAM_PENDING_TTL:
+                    break
+                self.pending.popitem(last=False)
+
+    # Join the in-flight stream for this key, starting it if needed
+    def _stream(self, cache_key):
+        with self.lock:
+            stream = self.streams.get(cache_key)
+            if stream:
+                return stream
+            request = self.pending.pop(cache_key, None)
+            if request is None or time.monotonic() - request[2] > TTS_STREAM_PENDING_TTL:
+                return None
+            stream = self.streams[cache_key] = NarrationStream(*request[:2])
+        threading.Thread(target=self._synthesize, args=(cache_key, stream), daemon=True).start()
+        return stream
+
+    def _synthesize(self, cache_key, stream):
+        url, headers, data = tts_request(stream.text, stream=True, profile=stream.profile)
+        get_quota_schedulers()["elevenlabs"].acquire({"characters": len(stream.text)}, "interactive")
+        start = time.perf_counter()
+        try:
+            with post_with_retries(url, breaker=self.breaker, json=data, headers=headers, stream=True) as response:
+                for chunk in response.iter_content(chunk_size=TTS_STREAM_CHUNK_SIZE):
+                    if chunk:
+                        stream.append(chunk)
+            audio = b"".join(stream.chunks)
+            self.audio_cache.put(cache_key, audio)
+            record_provider_call("tts_stream", time.perf_counter() - start, cache="miss",
+                                 response_bytes=len(audio), retries=response.retries)
+            stream.finish()
+        except requests.exceptions.RequestException as e:
+            record_provider_call("tts_stream", time.perf_counter() - start, cache="miss", outcome="error")
+            logger.warning("Streaming narration failed: %s", e)
+            self._register(cache_key, stream.text, stream.profile)  # Allow the browser to retry
+            stream.finish(failed=True)
+        finally:
+            with self.lock:
+                self.streams.pop(cache_key, None)
+
+    def handle(self, request):
+        cache_key = audio_key(request.path.rsplit("/", 1)[-1])
+        etag = f'"{cache_key}"'
+        cached_audio = self.audio_cache.get(cache_key)
+        if cached_audio:
+            if request.headers.get("If-None-Match") == etag:
+                request.send_response(304)
+                request.end_headers()
+                return
+            request.send_response(200)
+            request.send_header("Content-Type", audio_mime_type(cache_key))
+            request.send_header("Content-Length", str(len(cached_audio)))
+            request.send_header("Cache-Control", "public, max-age=31536000, immutable")
+            request.send_header("ETag", etag)
+            request.end_headers()
+            request.wfile.write(cached_audio)
+            return
+        
+        stream = self._stream(cache_key)
+        if stream is None:
+            request.send_error(404)
+            return
+        request.protocol_version = "HTTP/1.1"
+        request.send_response(200)
+        request.send_header("Content-Type", audio_mime_type(cache_key))
+        request.send_header("Transfer-Encoding", "chunked")
+        request.send_header("Cache-Control", "no-store")
+        request.end_headers()
+        try:
+            for chunk in stream.iter_chunks():
+                request.wfile.write(f"{len(chunk):X}\r\n".encode() + chunk + b"\r\n")
+                request.wfile.flush()
+            request.wfile.write(b"0\r\n\r\n")
+        except OSError:
+            pass  # Browser stopped listening; synthesis continues for the cache
+
+@shared
+def get_narration_stream_server():
+    return NarrationStreamServer(get_audio_cache(), get_tts_breaker(), TTS_STREAM_HOST, TTS_STREAM_PORT)
+
+# Synthesize the fixed phrases once per process so games never wait on them
+@shared
+def prewarm_fixed_phrases():
+    def prewarm():
+        for profile in dict.fromkeys([AUDIO_PROFILE_MOBILE, AUDIO_PROFILE_DESKTOP]):
+            for phrase in FIXED_PHRASES:
+                run_in_context({"audio_profile": profile}, text_to_speech, phrase)
+    thread = threading.Thread(target=run_in_context, args=({"priority": "background"}, prewarm), name="tts-prewarm", daemon=True)
+    thread.start()
+    return thread
+
+# Published audio clips served as static files, named by the hash of their contents
+@shared
+def get_published_audio():
+    return AudioCache(STATIC_AUDIO_DIR, STATIC_AUDIO_MAX_BYTES)
+
+# Reference-counted store for audio clips. Sessions keep only the reference (the clip's content hash);
+# the bytes live once on disk in the published folder and stay pinned while any holder references them.
+class BlobStore:
+    def __init__(self, files, session_ttl):
+        self.files = files
+        self.session_ttl = session_ttl
+        self.lock = threading.Lock()
+        self.holders = {}  # holder id -> {ref: size}
+        self.last_seen = {}  # session id -> time of its last rerun
+
+    # Store a clip for a holder and return its reference
+    def put(self, holder, data):
+        ref = hashlib.sha256(data).hexdigest() + {b"RIFF": ".wav", b"OggS": ".ogg"}.get(data[:4], "")
+        self.acquire(holder, ref, len(data))
+        if not self.files.contains(ref):
+            self.files.put(ref, data)
+        return ref
+
+    def acquire(self, holder, ref, size=None):
+        with self.lock:
+            held = self.holders.setdefault(holder, {})
+            if ref in held:
+                return
+            held[ref] = self.files.size(ref) if size is None else size
+        self.files.pin(ref)
+
+    # Release one reference, or everything the holder has
+    def release(self, holder, ref=None):
+        with self.lock:
+            held = self.holders.get(holder, {})
+            refs = [ref] if ref is not None else list(held)
+            released = [ref for ref in refs if held.pop(ref, None) is not None]
+            if not held:
+                self.holders.pop(holder, None)
+        for ref in released:
+            self.files.unpin(ref)
+
+    # Record a rerun for the session and release sessions that have gone away. A session that comes back
+    # after its clips were released holds the refs it still keeps again; returns those whose clips are gone.
+    def touch(self, session_id, refs=()):
+        now = time.time()
+        with self.lock:
+            returning = session_id not in self.last_seen
+            self.last_seen[session_id] = now
+            expired = [holder for holder, seen in self.last_seen.items() if now - seen > self.session_ttl]
+            for holder in expired:
+                del self.last_seen[holder]
+        for holder in expired:
+            self.release(holder)
+        missing = []
+        for ref in refs if returning else ():
+            if self.files.contains(ref):
+                self.acquire(session_id, ref)
+            else:
+                missing.append(ref)
+        return missing
+
+    # Bytes referenced by each holder, and the bytes actually stored once each
+    def stats(self):
+        with self.lock:
+            per_holder = {holder: sum(held.values()) for holder, held in self.holders.items()}
+            unique = {}
+            for held in self.holders.values():
+                unique.update(held)
+        return {"holders": per_holder, "total_bytes": sum(unique.values()), "blobs": len(unique),
+                "referenced_bytes": sum(per_holder.values())}
+
+@shared
+def get_blob_store():
+    return BlobStore(get_published_audio(), BLOB_SESSION_TTL)
+
+# Saved games in SQLite (WAL mode, so saves from many sessions do not block reads). Each row is one game's
+# state as JSON; audio and images are stored as references to the shared files, never as bytes.
+class GameStore:
+    def __init__(self, path, ttl):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS games (token TEXT PRIMARY KEY, state TEXT NOT NULL, updated REAL NOT NULL)")
+        self.connection.execute("DELETE FROM games WHERE updated < ?", (time.time() - ttl,))
+
+    def load(self, token):
+        with self.lock:
+            row = self.connection.execute("SELECT state FROM games WHERE token = ?", (token,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, token, state):
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO games (token, state, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(token) DO UPDATE SET state = excluded.state, updated = excluded.updated",
+                (token, state, time.time()))
+
+    def delete(self, token):
+        with self.lock:
+            self.connection.execute("DELETE FROM games WHERE token = ?", (token,))
+
+@shared
+def get_game_store():
+    return GameStore(GAME_STORE_PATH, GAME_STORE_TTL)
+
+# Adventure pool settings: refill a theme up to the high watermark once it drops to the low one
+ADVENTURE_POOL_HIGH_WATERMARK = int(os.getenv("ADVENTURE_POOL_HIGH_WATERMARK", "2"))
+ADVENTURE_POOL_LOW_WATERMARK = int(os.getenv("ADVENTURE_POOL_LOW_WATERMARK", "1"))
+ADVENTURE_POOL_RETRY_DELAY = 30  # Seconds to wait after a failed background generation
+ADVENTURE_POOL_HOLDER = "adventure-pool"  # Blob store holder for the pooled intro narrations
+
+# Function to build a complete adventure (story, riddles, background and intro narration)
+def build_adventure(theme):
+    pipeline = start_adventure_pipeline(theme, narrate=("intro",), priority="background")
+    main_story, _ = pipeline.result("storyline")
+    riddles = [pipeline.result(f"riddle_{i}") for i in range(NUM_RIDDLES)]
+    intro_audio = pipeline.result("audio:intro")
+    adventure = {"main_story": main_story, "riddles": riddles, "image": None,
+                 "intro_audio": get_blob_store().put(ADVENTURE_POOL_HOLDER, intro_audio) if intro_audio else None}
+    try:
+        adventure["image"] = pipeline.result("image")
+    except Exception as e:
+        logger.warning("Pooled image generation failed for %s: %s", theme, e)
+    return adventure
+
+# Keeps a few ready-made adventures per theme, refilled by a background worker thread
+class AdventurePool:
+    def __init__(self, themes, high_watermark, low_watermark):
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+        self.pools = {theme: deque() for theme in themes}
+        self.refilling = set(themes)  # Themes currently being topped up to the high watermark
+        self.condition = threading.Condition()
+        if self.high_watermark > 0:
+            threading.Thread(target=self._worker, name="adventure-pool", daemon=True).start()
+
+    # Take a ready adventure for the theme, or None if the pool is empty
+    def take(self, theme):
+        with self.condition:
+            pool = self.pools.get(theme)
+            adventure = pool.popleft() if pool else None
+            if pool is not None and len(pool) <= self.low_watermark:
+                self.refilling.add(theme)
+                self.condition.notify()
+            if adventure is not None:
+                self._publish_size(theme)
+            return adventure
+
+    def _publish_size(self, theme):
+        get_metrics().set("mindvault_adventure_pool_size", {"theme": theme}, len(self.pools[theme]))
+
+    # Pick the emptiest theme that still needs refilling
+    def _next_theme(self):
+        for theme in list(self.refilling):
+            if len(self.pools[theme]) >= self.high_watermark:
+                self.refilling.discard(theme)
+        if not self.refilling:
+            return None
+        return min(self.refilling, key=lambda theme: len(self.pools[theme]))
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                theme = self._next_theme()
+                while theme is None:
+                    self.condition.wait()
+                    theme = self._next_theme()
+            try:
+                adventure = build_adventure(theme)
+            except Exception as e:
+                logger.warning("Background adventure generation failed for %s: %s", theme, e)
+                time.sleep(ADVENTURE_POOL_RETRY_DELAY)
+                continue
+            with self.condition:
+                self.pools[theme].append(adventure)
+                self._publish_size(theme)
+
+# Synthesizes narration the player is likely to need next, within a per-session concurrency budget
+class NarrationPrefetcher:
+    def __init__(self, executor, max_in_flight):
+        self.executor = executor
+        self.budget = threading.BoundedSemaphore(max_in_flight)
+        self.futures = {}  # session audio key -> Future
+
+    # Start synthesizing unless it is already in flight or the budget is used up
+    def prefetch(self, key, segments):
+        if key in self.futures or not self.budget.acquire(blocking=False):
+            return
+        try:
+            future = self.executor.submit(run_in_context, capture_call_context(priority="background"), narration_to_speech, segments)
+        except RuntimeError:
+            self.budget.release()
+            return
+        future.add_done_callback(lambda _: self.budget.release())  # Also runs when cancelled
+        self.futures[key] = future
+
+    def pending(self, key):
+        return key in self.futures
+
+    # Wait for a prefetched clip; None if it failed or was cancelled
+    def take(self, key):
+        try:
+            return self.futures.pop(key).result()
+        except Exception:
+            return None
+
+    # Remove and return every clip that has finished
+    def collect(self):
+        finished = {}
+        for key in [key for key, future in self.futures.items() if future.done()]:
+            audio = self.take(key)
+            if audio:
+                finished[key] = audio
+        return finished
+
+    def cancel(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.futures.clear()
+
+@shared
+def get_adventure_pool():
+    return AdventurePool(THEMES, ADVENTURE_POOL_HIGH_WATERMARK, ADVENTURE_POOL_LOW_WATERMARK)
+
+# POST a job to the generation service, recording it like a provider call; identical concurrent jobs share one request
+def call_generation_service(endpoint, payload):
+    stage = f"service:{endpoint}"
+    priority = current_priority()
+    
+    def request():
+        start = time.perf_counter()
+        try:
+            response = post_with_retries(f"{GENERATION_SERVICE_URL}/{endpoint}", json=dict(payload, priority=priority),
+                                         timeout=(TTS_CONNECT_TIMEOUT, GENERATION_SERVICE_TIMEOUT + GENERATION_SERVICE_READ_MARGIN),
+                                         retry_statuses=GENERATION_SERVICE_RETRY_STATUS_CODES, retry_read_timeouts=False)
+        except requests.exceptions.RequestException:
+            record_provider_call(stage, time.perf_counter() - start, outcome="error")
+            raise
+        record_provider_call(stage, time.perf_counter() - start,
+                             response_bytes=len(response.content), retries=response.retries)
+        return response
+    
+    start = time.perf_counter()
+    response, shared = get_single_flight().do(("service", request_fingerprint(endpoint, payload, priority)), request)
+    if shared:
+        record_provider_call(stage, time.perf_counter() - start, cache="coalesced")
+    return response
+
+# Fetch a whole adventure from the generation service, in the (main_story, locations, riddles) form of the structured mode
+def request_adventure(theme, num_riddles, mode):
+    adventure = call_generation_service("generate-adventure", {"theme": theme, "num_riddles": num_riddles, "mode": mode}).json()
+    riddles = adventure["riddles"]
+    for riddle in riddles:
+        riddle["answer_index"] = build_answer_index(riddle["answer"], riddle.get("synonyms", []))
+    return adventure["main_story"], [riddle["location"] for riddle in riddles], riddles
+
+# Standalone generation service: HTTP handler threads queue jobs for a fixed pool of workers
+# and wait for the result, so slow provider calls never run on a Streamlit script thread
+class GenerationService:
+    def __init__(self, host, port, workers, queue_size):
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.workers = workers
+        self.endpoints = {  # path -> (job, required field)
+            "/generate-adventure": (self.generate_adventure, "theme"),
+            "/generate-image": (lambda payload: {"url": generate_image(payload["theme"])}, "theme"),
+            "/synthesize-speech": (lambda payload: text_to_speech(payload["text"]), "text")
+        }
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                service.handle_status(self)
+
+            def do_POST(self):
+                service.handle(self)
+
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"generation-service-{i}", daemon=True).start()
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    def _worker(self):
+        while True:
+            future, func, payload = self.jobs.get()
+            if future.set_running_or_notify_cancel():
+                priority = payload.get("priority")
+                context = {"priority": priority if priority in PRIORITY_CLASSES else "generation",
+                           "audio_profile": payload.get("profile") if payload.get("profile") in AUDIO_PROFILES else None}
+                try:
+                    future.set_result(run_in_context(context, func, payload))
+                except Exception as e:
+                    future.set_exception(e)
+            self.jobs.task_done()
+
+    # Queue a job, raising queue.Full when the service is saturated
+    def submit(self, func, payload):
+        future = Future()
+        self.jobs.put_nowait((future, func, payload))
+        return future
+
+    def generate_adventure(self, payload):
+        num_riddles = payload.get("num_riddles", NUM_RIDDLES)
+        pipeline = start_adventure_pipeline(payload["theme"], num_riddles, image=False,
+                                            mode=payload.get("mode", GENERATION_MODE), priority=current_priority())
+        main_story, _ = pipeline.result("storyline")
+        riddles = [pipeline.result(f"riddle_{i}") for i in range(num_riddles)]
+        return {"main_story": main_story,
+                "riddles": [{key: value for key, value in riddle.items() if key != "answer_index"} for riddle in riddles]}
+
+    def send(self, request, status, content_type, body, headers=()):
+        request.send_response(status)
+        request.send_header("Content-Type", content_type)
+        request.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(body)
+
+    def handle_status(self, request):
+        if request.path != "/health":
+            request.send_error(404)
+            return
+        status = {"queued": self.jobs.qsize(), "queue_size": self.jobs.maxsize, "workers": self.workers,
+                  "quota_queue_depth": {name: quota.queue_depth() for name, quota in get_quota_schedulers().items()}}
+        self.send(request, 200, "application/json", json.dumps(status).encode())
+
+    def handle(self, request):
+        if request.path not in self.endpoints:
+            request.send_error(404)
+            return
+        func, required = self.endpoints[request.path]
+        try:
+            payload = json.loads(request.rfile.read(int(request.headers.get("Content-Length", 0))) or b"{}")
+            if not isinstance(payload, dict) or not isinstance(payload.get(required), str):
+                raise ValueError(f"missing {required}")
+            num_riddles = payload.get("num_riddles", NUM_RIDDLES)
+            if isinstance(num_riddles, bool) or not isinstance(num_riddles, int) or num_riddles < 1:
+                raise ValueError("num_riddles must be a positive integer")
+            future = self.submit(func, payload)
+        except ValueError as e:
+            self.send(request, 400, "application/json", json.dumps({"error": str(e)}).encode())
+            return
+        except queue.Full:
+            self.send(request, 503, "application/json", b'{"error": "generation queue is full"}', [("Retry-After", "1")])
+            return
+        try:
+            result = future.result(GENERATION_SERVICE_TIMEOUT)
+        except Exception as e:
+            future.cancel()
+            logger.warning("Generation job %s failed: %s", request.path, e)
+            self.send(request, 502, "application/json", json.dumps({"error": str(e)}).encode())
+            return
+        if request.path == "/synthesize-speech":
+            if not result:
+                self.send(request, 502, "application/json", b'{"error": "speech synthesis failed"}')
+                return
+            profile = payload.get("profile") if payload.get("profile") in AUDIO_PROFILES else AUDIO_PROFILE_DESKTOP
+            self.send(request, 200, AUDIO_PROFILES[profile]["mime_type"], result)
+        else:
+            self.send(request, 200, "application/json", json.dumps(result).encode())
+
+# Run only the generation service: python mindvault.py serve
+if __name__ == "__main__" and sys.argv[1:2] == ["serve"]:
+    GENERATION_SERVICE_URL = None  # The service itself always generates in-process
+    logging.basicConfig(level=logging.INFO)
+    service = GenerationService(GENERATION_SERVICE_HOST, GENERATION_SERVICE_PORT,
+                                GENERATION_SERVICE_WORKERS, GENERATION_SERVICE_QUEUE_SIZE)
+    logger.info("Generation service listening on %s:%d", GENERATION_SERVICE_HOST, GENERATION_SERVICE_PORT)
+    try:
+        service.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
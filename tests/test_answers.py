@@ -0,0 +1,56 @@
+import pytest
+
+from mindvault import answer_matches, build_answer_index
+
+
+def test_index_splits_listed_answers_and_adds_synonyms():
+    index = build_answer_index("Piano (or keyboard)", ["grand piano"])
+    assert {"piano", "keyboard", "grand piano"} <= index["forms"]
+
+
+def test_index_holds_normalized_and_stemmed_forms():
+    index = build_answer_index("The Candles")
+    assert {"candles", "candle"} <= index["forms"]
+
+
+def test_index_tolerates_typos_on_normalized_forms_only_past_four_letters():
+    index = build_answer_index("glass, key, telescope")
+    assert dict(index["fuzzy"]) == {"glass": 1, "telescope": 2}
+
+
+def test_index_skips_empty_candidates():
+    index = build_answer_index("piano,", ["", "!"])
+    assert index["forms"] == {"piano"}
+
+
+@pytest.mark.parametrize("answer, submission", [
+    ("piano", "Piano"),
+    ("piano", "the piano!"),
+    ("piano (or keyboard)", "keyboard"),
+    ("shoes", "shoe"),
+    ("candle", "candles"),
+    ("compass", "compasses"),
+    ("compass", "compas"),
+    ("glass", "glas"),
+    ("telescope", "telscope"),
+    ("telescope", "telescoep"),
+])
+def test_accepts(answer, submission):
+    assert answer_matches(build_answer_index(answer), submission)
+
+
+@pytest.mark.parametrize("answer, submission", [
+    ("candle", "handle"),
+    ("clock", "lock"),
+    ("river", "liver"),
+    ("river", "rover"),
+    ("key", "kez"),
+    ("piano", ""),
+    ("piano", "the"),
+])
+def test_rejects(answer, submission):
+    assert not answer_matches(build_answer_index(answer), submission)
+
+
+def test_synonyms_match():
+    assert answer_matches(build_answer_index("piano", ["keyboard"]), "keyboards")
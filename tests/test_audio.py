@@ -0,0 +1,23 @@
+from mindvault import join_mp3
+
+# One MPEG-1 Layer III frame: 128 kbps, 44.1 kHz, 417 bytes
+FRAME = b"\xff\xfb\x90\x00" + bytes(413)
+
+
+def test_joins_mp3_clips_frame_by_frame():
+    assert join_mp3([FRAME * 2, FRAME]) == FRAME * 3
+
+
+def test_skips_id3_tags():
+    tag = b"ID3\x04\x00\x00\x00\x00\x00\x02" + bytes(2)
+    assert join_mp3([tag + FRAME, FRAME]) == FRAME * 2
+
+
+def test_rejects_clips_in_another_format():
+    mpeg2_frame = b"\xff\xf3\x90\x00" + bytes(257)  # MPEG-2: 80 kbps, 22.05 kHz
+    assert join_mp3([FRAME, mpeg2_frame]) is None
+
+
+def test_rejects_wav_and_ogg_even_with_frame_like_bytes():
+    assert join_mp3([FRAME, b"RIFF" + bytes(40) + FRAME]) is None
+    assert join_mp3([b"OggS" + bytes(24) + FRAME, FRAME]) is None
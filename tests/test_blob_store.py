@@ -0,0 +1,28 @@
+from mindvault import AudioCache, BlobStore
+
+
+def test_returning_session_holds_its_clips_again(tmp_path, monkeypatch):
+    files = AudioCache(str(tmp_path), 1 << 20)
+    blobs = BlobStore(files, session_ttl=60)
+    clock = [1000.0]
+    monkeypatch.setattr("mindvault.time.time", lambda: clock[0])
+    blobs.touch("player")
+    kept = blobs.put("player", b"RIFF kept")
+    evicted = blobs.put("player", b"RIFF evicted")
+
+    clock[0] += 120
+    blobs.touch("someone else")
+    assert "player" not in blobs.holders
+    files.entries.pop(evicted)  # Evicted while nobody held it
+
+    assert blobs.touch("player", [kept, evicted]) == [evicted]
+    assert blobs.holders["player"] == {kept: len(b"RIFF kept")}
+    assert kept in files.pins
+
+
+def test_active_session_keeps_its_holds(tmp_path):
+    blobs = BlobStore(AudioCache(str(tmp_path), 1 << 20), session_ttl=60)
+    blobs.touch("player")
+    ref = blobs.put("player", b"RIFF clip")
+    assert blobs.touch("player", [ref]) == []
+    assert blobs.holders["player"] == {ref: len(b"RIFF clip")}
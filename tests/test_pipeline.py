@@ -0,0 +1,70 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from mindvault import StageScheduler
+
+
+def flaky(failures):
+    calls = []
+
+    def stage(*args):
+        calls.append(args)
+        if len(calls) <= failures:
+            raise RuntimeError("provider hiccup")
+        return "riddle"
+    return stage, calls
+
+
+def test_failed_stage_is_retried():
+    stage, calls = flaky(1)
+    pipeline = StageScheduler(ThreadPoolExecutor(max_workers=2))
+    pipeline.add("storyline", lambda: "story")
+    pipeline.add("riddle_0", stage, ["storyline"], attempts=2)
+    assert pipeline.result("riddle_0", timeout=10) == "riddle"
+    assert calls == [("story",), ("story",)]
+
+
+def test_stage_fails_after_its_attempts():
+    stage, calls = flaky(3)
+    pipeline = StageScheduler(ThreadPoolExecutor(max_workers=2))
+    pipeline.add("riddle_0", stage, attempts=2)
+    pipeline.add("riddle_1", lambda riddle: riddle, ["riddle_0"])
+    with pytest.raises(RuntimeError):
+        pipeline.result("riddle_1", timeout=10)
+    assert len(calls) == 2
+
+
+def test_gate_holds_stages_until_opened():
+    pipeline = StageScheduler(ThreadPoolExecutor(max_workers=2))
+    pipeline.add_gate("reached_0")
+    pipeline.add("riddle_2", lambda _: "riddle", ["reached_0"])
+    assert not pipeline.ready("riddle_2")
+    pipeline.open("reached_0")
+    assert pipeline.result("riddle_2", timeout=10) == "riddle"
+
+
+def riddle(text, answer):
+    return {"location": "Vault", "riddle": text, "answer": answer, "hint": ""}
+
+
+def test_regenerated_riddle_is_told_what_it_clashed_with(monkeypatch):
+    earlier = riddle("What has keys but opens no locks?", "piano")
+    prompts = []
+
+    def generate_riddle(theme, location, previous_riddles=""):
+        prompts.append(previous_riddles)
+        return riddle("I tick all day and never leave the wall.", "clock")
+    monkeypatch.setattr("mindvault.generate_riddle", generate_riddle)
+    from mindvault import ensure_distinct_riddle
+    assert ensure_distinct_riddle("Space", riddle("What has many keys but no doors?", "piano"), [earlier])["answer"] == "clock"
+    assert len(prompts) == 1
+    assert "What has keys but opens no locks? (Answer: piano)" in prompts[0]
+
+
+def test_duplicate_is_kept_and_logged_after_the_regenerations(monkeypatch, caplog):
+    earlier = riddle("What has keys but opens no locks?", "piano")
+    monkeypatch.setattr("mindvault.generate_riddle", lambda theme, location, previous_riddles="": riddle("Keys but no locks?", "piano"))
+    from mindvault import ensure_distinct_riddle
+    assert ensure_distinct_riddle("Space", riddle("Keys but no locks?", "piano"), [earlier])["answer"] == "piano"
+    assert "still similar" in caplog.text
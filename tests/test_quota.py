@@ -0,0 +1,58 @@
+import threading
+import time
+
+from mindvault import QuotaScheduler, SingleFlight
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_higher_priority_goes_first():
+    quota = QuotaScheduler("test", {"requests": 600})
+    quota.acquire({"requests": 600}, "interactive")
+    order = []
+    background = threading.Thread(target=lambda: (quota.acquire({"requests": 1}, "background"), order.append("background")))
+    background.start()
+    wait_until(lambda: quota.queue_depth()["background"] == 1)
+    quota.acquire({"requests": 1}, "interactive")
+    order.append("interactive")
+    background.join()
+    assert order == ["interactive", "background"]
+
+
+def test_waiting_caller_can_be_promoted():
+    quota = QuotaScheduler("test", {"requests": 600})
+    quota.acquire({"requests": 600}, "interactive")
+    priority = ["background"]
+    order = []
+    promoted = threading.Thread(target=lambda: (quota.acquire({"requests": 1}, lambda: priority[0]), order.append("promoted")))
+    promoted.start()
+    wait_until(lambda: quota.queue_depth()["background"] == 1)
+    generation = threading.Thread(target=lambda: (quota.acquire({"requests": 1}, "generation"), order.append("generation")))
+    generation.start()
+    wait_until(lambda: quota.queue_depth()["generation"] == 1)
+    priority[0] = "interactive"
+    quota.wake()
+    promoted.join()
+    generation.join()
+    assert order == ["promoted", "generation"]
+
+
+def test_joining_caller_raises_the_flight_priority():
+    flights = SingleFlight()
+    release = threading.Event()
+    seen = []
+    leader = threading.Thread(target=lambda: flights.do("key", lambda: (release.wait(5), flights.priority("key"))[1], "background"))
+    leader.start()
+    wait_until(lambda: "key" in flights.calls)
+    follower = threading.Thread(target=lambda: seen.append(flights.do("key", lambda: None, "interactive", lambda: seen.append("joined"))))
+    follower.start()
+    wait_until(lambda: seen == ["joined"])
+    assert flights.priority("key") == "interactive"
+    release.set()
+    follower.join()
+    assert seen[1] == ("interactive", True)
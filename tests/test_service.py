@@ -0,0 +1,47 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import mindvault
+
+
+@pytest.fixture
+def service(monkeypatch):
+    requests_seen = []
+    status = [502]
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            requests_seen.append(self.path)
+            self.send_response(status[0])
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"{}")
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    monkeypatch.setattr(mindvault, "GENERATION_SERVICE_URL", f"http://127.0.0.1:{httpd.server_port}")
+    monkeypatch.setattr(mindvault, "backoff_delay", lambda attempt, response=None: 0)
+    yield requests_seen, status
+    httpd.shutdown()
+
+
+def test_failed_job_is_not_sent_again(service):
+    requests_seen, status = service
+    with pytest.raises(requests.exceptions.HTTPError):
+        mindvault.call_generation_service("generate-adventure", {"theme": "Space Odyssey"})
+    assert requests_seen == ["/generate-adventure"]
+
+
+def test_full_queue_is_retried(service):
+    requests_seen, status = service
+    status[0] = 503
+    with pytest.raises(requests.exceptions.HTTPError):
+        mindvault.call_generation_service("generate-image", {"theme": "Space Odyssey"})
+    assert len(requests_seen) == mindvault.HTTP_MAX_RETRIES + 1